@@ -1,5 +1,14 @@
 # -*- coding: UTF-8 -*-
+import array
+import collections
+import json
 import math
+import mmap
+import os
+import sys
+
+# first bytes of binary model files (see NB.save_binary)
+BINARY_MAGIC = b'KZLIDNB1'
 
 
 def softmax(data, maxval=None):
@@ -21,19 +30,39 @@ class NB():
         self.level = 'WORD'
         self.other = 'other'
         self.min_ngram, self.max_ngram = 1, 1
-        self.trm_probs = {}
+        # feature table: row index per term (N-gram, <OOV> or <PRR>) and
+        # a row-major [terms x classes] matrix of log probabilities
+        self.features = {}
+        self.weights = array.array('d')
+        # trie of the terms' units (characters or words) read right to
+        # left: unit -> [row of the term ending here or None, subtrie]
+        self.suffixes = {}
+        # largest change of the difference between two class scores
+        # an N-gram (and the priors) can make, for early stopping
+        self.max_swing = 0.0
+        self.prior_swing = 0.0
+        # (line number, line) pairs of malformed feature lines
+        # skipped when loading a text model
+        self.skipped = []
         self.load_model(mdl_fn)
 
     def load_model(self, fn):
+        ''' load a model from a file (text or binary, see save_binary) '''
+        with open(fn, 'rb') as fd:
+            if fd.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+                return self.load_binary(fn)
 
         def reset_secs(d):
             return {k: 0 for k in d}
 
+        # missing values (NaN), filled in once the whole model is read
+        missing = float('nan')
+        columns = {}
         secs = {'ngram_range': 0,
                 'classes': 0,
                 'feature-type': 0,
                 'features': 0}
-        for line in open(fn, 'r').readlines():
+        for i, line in enumerate(open(fn, 'r')):
             line = line.strip()
             if not line:
                 continue
@@ -54,51 +83,239 @@ class NB():
                 [self.min_ngram, self.max_ngram] = [
                         int(v) for v in line.split()]
             elif secs['classes']:
+                columns[line] = len(self.classes)
                 self.classes.append(line)
             elif secs['feature-type']:
                 self.level = (line in ['CHAR', 'WORD']) and line or self.level
             elif secs['features']:
                 try:
                     [trm, lbl, prb] = line.split('\t')
-                except:
+                    prb = float(prb)
+                except ValueError:
+                    self.skipped.append((i + 1, line))
+                    continue
+                if lbl not in columns:
+                    self.skipped.append((i + 1, line))
                     continue
-                self.trm_probs[trm, lbl] = float(prb)
+                row = self.features.get(trm)
+                if row is None:
+                    row = self.features[trm] = len(self.features)
+                    self.weights.extend(len(self.classes) * [missing])
+                self.weights[row * len(self.classes) + columns[lbl]] = prb
         self.other = self.classes[-1]
+        # terms missing a class score as <OOV> (priors as zero)
+        ncls = len(self.classes)
+        for trm, row in self.features.items():
+            for c in range(ncls):
+                if not math.isnan(self.weights[row * ncls + c]):
+                    continue
+                if trm == '<PRR>':
+                    self.weights[row * ncls + c] = 0.0
+                else:
+                    self.weights[row * ncls + c] = self.get_weight(
+                            '<OOV>', c)
+        self.index_features()
+
+    def save_binary(self, fn):
+        '''
+        save a model to a binary file: a JSON header with parameters,
+        classes and terms (in row order), followed by the 8-byte aligned
+        [terms x classes] float64 matrix of log probabilities
+        '''
+        header = json.dumps({
+                'byteorder': sys.byteorder,
+                'level': self.level,
+                'min_ngram': self.min_ngram,
+                'max_ngram': self.max_ngram,
+                'classes': self.classes,
+                'terms': list(self.features)}).encode('utf-8')
+        header += (-len(header) % 8) * b' '
+        # write a new file and move it over the old one, which this or
+        # other processes may have mapped (see load_binary)
+        tmp = f'{fn}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as fd:
+                fd.write(BINARY_MAGIC)
+                fd.write(len(header).to_bytes(8, 'little'))
+                fd.write(header)
+                fd.write(array.array('d', self.weights).tobytes())
+            os.replace(tmp, fn)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def load_binary(self, fn):
+        '''
+        load a model from a binary file (see save_binary); the matrix is
+        memory-mapped (unless the file has a different byte order), so
+        processes loading the same file share its pages
+        '''
+        with open(fn, 'rb') as fd:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(mm)
+        try:
+            if bytes(buf[:len(BINARY_MAGIC)]) != BINARY_MAGIC:
+                raise ValueError('Error loading model.\
+                                 Not a binary NB model file')
+            pos = len(BINARY_MAGIC) + 8
+            size = int.from_bytes(buf[len(BINARY_MAGIC):pos], 'little')
+            if pos + size > len(buf):
+                raise ValueError('Error loading model.\
+                                 Binary model file is truncated')
+            try:
+                header = json.loads(bytes(buf[pos:pos+size]).decode('utf-8'))
+                classes = [str(c) for c in header['classes']]
+                terms = [str(t) for t in header['terms']]
+                level = header['level']
+                min_ngram = int(header['min_ngram'])
+                max_ngram = int(header['max_ngram'])
+                byteorder = header['byteorder']
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('Error loading model.\
+                                 Malformed binary model header')
+            if not classes or '<OOV>' not in terms or not (
+                    0 < min_ngram <= max_ngram) or (
+                    level not in ['CHAR', 'WORD']) or (
+                    byteorder not in ['little', 'big']) or (
+                    len(set(terms)) != len(terms)):
+                raise ValueError('Error loading model.\
+                                 Invalid binary model parameters')
+            pos += size
+            nbytes = len(terms) * len(classes) * 8
+            if pos + nbytes != len(buf):
+                raise ValueError('Error loading model.\
+                                 Binary model file is truncated or\
+                                 has trailing data')
+            if byteorder == sys.byteorder:
+                weights = buf[pos:].cast('d')
+            else:
+                # swapped copy of the matrix, the file is not kept mapped
+                weights = array.array('d')
+                weights.frombytes(buf[pos:])
+                weights.byteswap()
+                buf.release()
+                mm.close()
+        except BaseException:
+            buf.release()
+            mm.close()
+            raise
+        self.level = level
+        self.min_ngram, self.max_ngram = min_ngram, max_ngram
+        self.classes = classes
+        self.other = self.classes[-1]
+        self.features = {trm: row for row, trm in enumerate(terms)}
+        self.weights = weights
+        self.index_features()
+
+    def index_features(self):
+        ''' compute early stopping bounds and build the suffix trie '''
+        ncls = len(self.classes)
+        for trm, row in self.features.items():
+            vals = self.weights[row * ncls:(row + 1) * ncls]
+            if trm == '<PRR>':
+                self.prior_swing = max(vals) - min(vals)
+            else:
+                self.max_swing = max(self.max_swing, max(vals) - min(vals))
+        # build the suffix trie
+        for trm, row in self.features.items():
+            node = [None, self.suffixes]
+            for unit in reversed(trm.split(' ')):
+                node = node[1].setdefault(unit, [None, {}])
+            node[0] = row
 
-    def predict(self, toks):
-        return self.predict_wp(toks).get('result')
+    def get_rows(self, doc, oov):
+        '''
+        Feature table rows of the N-grams of a document (a list of units),
+        by N-gram end position and then length, [oov] for unknown ones.
+        N-grams ending at a position are found by a single walk down the
+        suffix trie, without building N-gram strings.
+        '''
+        rows = []
+        if any(' ' in unit for unit in doc):
+            # units with spaces are ambiguous in the trie -
+            # look up the joined N-grams instead
+            for t in range(len(doc)):
+                for i in range(self.min_ngram,
+                               min(t + 1, self.max_ngram) + 1):
+                    ngm = ' '.join(doc[t + 1 - i:t + 1])
+                    rows.append(self.features.get(ngm, oov))
+            return rows
+        lo, hi = self.min_ngram, self.max_ngram
+        for t in range(len(doc)):
+            node = self.suffixes
+            # N-gram length
+            i = 0
+            for unit in range(t, t - hi if t >= hi else -1, -1):
+                i += 1
+                entry = node.get(doc[unit])
+                if entry is None:
+                    # no longer known N-grams end here
+                    top = t + 1 if t < hi else hi
+                    if top >= lo:
+                        rows.extend((top + 1 - (i if i > lo else lo)) * [oov])
+                    break
+                [row, node] = entry
+                if i >= lo:
+                    rows.append(oov if row is None else row)
+        return rows
 
-    def predict_wp(self, toks):
+    def get_weight(self, trm, c):
+        ''' log probability of a term for the class with index c '''
+        row = self.features[trm]
+        return self.weights[row * len(self.classes) + c]
+
+    def count_ngrams(self, n):
+        ''' number of N-grams in a document of [n] units '''
+        lo, hi = self.min_ngram, self.max_ngram
+        ret = max(0, n - hi + 1) * (hi - lo + 1)
+        for k in range(lo, min(n, hi - 1) + 1):
+            ret += k - lo + 1
+        return ret
+
+    def predict(self, toks, early_stop=False, margin=None, interval=64):
+        return self.predict_wp(toks, early_stop, margin, interval).get(
+                'result')
+
+    def predict_wp(self, toks, early_stop=False, margin=None, interval=64):
+        '''
+        Returns class probabilities and the best class under 'result'.
+        With [early_stop], scoring stops (checking every [interval]
+        N-grams) once the remaining N-grams can no longer change the best
+        class; with [margin], also once the best class leads by [margin]
+        (log-probability), which may change the result. In both cases
+        probabilities come from the scored N-grams only, and their number
+        is returned under the 'scored' key.
+        '''
         prbs = {}
+        rows = []
         docs = []
+        oov = self.features['<OOV>']
         if self.level == 'CHAR':
             for t in toks:
                 docs.append([c for c in t])
         else:
             docs.append(toks)
-        # compute probability of a document
-        for doc in docs:
-            if self.min_ngram == self.max_ngram == 1:
-                # unigrams do not require word/sentence initial/final symbols
-                pass
-            else:
-                doc = ['*'] + doc + ['*']
-            # ngram counts
-            buff = []
-            for tok in doc:
-                buff.append(tok)
-                if len(buff) < self.min_ngram:
-                    continue
-                if len(buff) > self.max_ngram:
-                    buff = buff[1:]
-                for i in range(self.min_ngram, self.max_ngram+1):
-                    if i > len(buff):
-                        continue
-                    ngm = ' '.join(buff[-1*i:])
-                    for c in self.classes:
-                        prbs[c] = prbs.get(c, 0.0)
-                        prbs[c] += self.trm_probs.get(
-                                (ngm, c), self.trm_probs['<OOV>', c])
+        if not (self.min_ngram == self.max_ngram == 1):
+            # unigrams do not require word/sentence initial/final symbols
+            docs = [['*'] + doc + ['*'] for doc in docs]
+        if early_stop or margin is not None:
+            [sums, scored] = self.score_early(docs, oov, margin, interval)
+            if scored:
+                prbs = dict(zip(self.classes, sums))
+        else:
+            # compute probability of a document
+            for doc in docs:
+                # ngram counts
+                rows.extend(self.get_rows(doc, oov))
+        # sum up the rows of all N-grams
+        if rows:
+            ncls = len(self.classes)
+            for c, cls in enumerate(self.classes):
+                prb = 0.0
+                for row in rows:
+                    prb += self.weights[row * ncls + c]
+                prbs[cls] = prb
         # if nothing came out - label as other
         if not prbs:
             ret = {c: (c == self.other and 1.0 or 0.0) for c in self.classes}
@@ -107,39 +324,166 @@ class NB():
             # add priors
             ret = {'result': [float('-inf'), 'None']}
             mxp = float('-inf')
-            for c in self.classes:
-                prbs[c] = prbs.get(c, 0.0)
-                prbs[c] += self.trm_probs.get(('<PRR>', c), 0.0)
-                if prbs[c] > mxp:
-                    mxp = prbs[c]
+            for c, cls in enumerate(self.classes):
+                if '<PRR>' in self.features:
+                    prbs[cls] += self.get_weight('<PRR>', c)
+                if prbs[cls] > mxp:
+                    mxp = prbs[cls]
             # normalize probabilities
             [argmax, ret] = softmax(prbs, mxp)
             ret['result'] = argmax
+        if early_stop or margin is not None:
+            ret['scored'] = scored
+        return ret
+
+    def score_early(self, docs, oov, margin=None, interval=64):
+        '''
+        Class scores of documents (see [predict_wp]) summed up N-gram by
+        N-gram until scoring can stop, returns the scores and the number
+        of scored N-grams.
+        '''
+        ncls = len(self.classes)
+        weights = self.weights
+        sums = ncls * [0.0]
+        scored = 0
+        remaining = sum(self.count_ngrams(len(doc)) for doc in docs)
+        for doc in docs:
+            for row in self.get_rows(doc, oov):
+                base = row * ncls
+                for c in range(ncls):
+                    sums[c] += weights[base + c]
+                scored += 1
+                remaining -= 1
+                if scored % interval or not remaining or ncls < 2:
+                    continue
+                [top, second] = sorted(sums, reverse=True)[:2]
+                # other classes can gain at most max_swing per N-gram
+                if top - second > (
+                        remaining * self.max_swing + self.prior_swing):
+                    return sums, scored
+                if margin is not None and top - second >= margin:
+                    return sums, scored
+        return sums, scored
+
+    def predict_batch(self, batch):
+        '''
+        Same as [predict_wp] for a list of token lists, returns a list
+        of results; identical inputs are scored only once.
+        '''
+        ret = []
+        scored = {}
+        for toks in batch:
+            key = tuple(toks)
+            if key not in scored:
+                scored[key] = self.predict_wp(toks)
+            ret.append(dict(scored[key]))
         return ret
 
 
 class LidNB():
 
-    def __init__(self, word_mdl=None, char_mdl=None):
+    def __init__(self, word_mdl=None, char_mdl=None, cache_size=0):
         self.word_mdl = word_mdl and NB(word_mdl) or None
         self.char_mdl = char_mdl and NB(char_mdl) or None
+        # LRU cache of predictions by token tuple, holding at most
+        # [cache_size] entries (0 disables caching)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        # cache hit and miss counters
+        self.hits = 0
+        self.misses = 0
 
-    def predict(self, toks):
-        return self.predict_wp(toks).get('result')
+    def predict(self, toks, early_stop=False, margin=None, interval=64):
+        return self.predict_wp(toks, early_stop, margin, interval).get(
+                'result')
 
-    def predict_wp(self, toks):
+    def predict_wp(self, toks, early_stop=False, margin=None, interval=64):
+        '''
+        Returns language probabilities and the best language under
+        'result' (see NB.predict_wp for early stopping, whose results
+        are not cached).
+        '''
+        if early_stop or margin is not None:
+            return self.score(toks, early_stop, margin, interval)
+        if not self.cache_size:
+            return self.score(toks)
+        key = tuple(toks)
+        ret = self.cache.get(key)
+        if ret is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return dict(ret)
+        self.misses += 1
+        ret = self.score(list(key))
+        self.cache[key] = dict(ret)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return ret
+
+    def cache_info(self):
+        ''' cache statistics: hits, misses, current and maximum size '''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.cache),
+                'maxsize': self.cache_size}
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def score(self, toks, early_stop=False, margin=None, interval=64):
         if self.word_mdl and self.char_mdl:
-            # combine model probabilities
-            prbs = {}
-            pd1 = self.word_mdl.predict_wp(toks)
-            del pd1['result']
-            pd2 = self.char_mdl.predict_wp(toks)
-            del pd2['result']
-            for k, v in pd1.items():
-                prbs[k] = pd1[k] + pd2[k]
-            [argmax, ret] = softmax(prbs)
-            ret['result'] = argmax
-            return ret
+            return self.combine(
+                    self.word_mdl.predict_wp(
+                            toks, early_stop, margin, interval),
+                    self.char_mdl.predict_wp(
+                            toks, early_stop, margin, interval))
         else:
             model = self.word_mdl or self.char_mdl
-            return model.predict_wp(toks)
+            return model.predict_wp(toks, early_stop, margin, interval)
+
+    def predict_batch(self, batch):
+        '''
+        Same as [predict_wp] for a list of token lists (e.g. a list of
+        words for per-word identification), returns a list of results.
+        '''
+        if self.cache_size:
+            return [self.predict_wp(toks) for toks in batch]
+        if self.word_mdl and self.char_mdl:
+            batch = list(batch)
+            return [self.combine(pd1, pd2) for pd1, pd2 in zip(
+                    self.word_mdl.predict_batch(batch),
+                    self.char_mdl.predict_batch(batch))]
+        else:
+            model = self.word_mdl or self.char_mdl
+            return model.predict_batch(batch)
+
+    def combine(self, pd1, pd2):
+        # combine model probabilities
+        prbs = {}
+        del pd1['result']
+        del pd2['result']
+        scored = None
+        if 'scored' in pd1:
+            scored = pd1.pop('scored') + pd2.pop('scored')
+        for k, v in pd1.items():
+            prbs[k] = pd1[k] + pd2[k]
+        [argmax, ret] = softmax(prbs)
+        ret['result'] = argmax
+        if scored is not None:
+            ret['scored'] = scored
+        return ret
+
+
+def convert_model(fn, binary_fn, log=sys.stderr):
+    '''
+    converts a text model to the binary format (see NB.save_binary),
+    reporting malformed lines skipped in the text model to [log];
+    returns the skipped (line number, line) pairs
+    '''
+    model = NB(fn)
+    for i, line in model.skipped:
+        log.write(f'{fn}, line {i}: skipped malformed line "{line}"\n')
+    model.save_binary(binary_fn)
+    return model.skipped
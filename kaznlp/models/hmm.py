@@ -1,306 +1,1239 @@
-#  -*- coding: UTF-8 -*-
-from __future__ import division
-import math
-import itertools
-
-
-# HMM with deleted interpolation
-class HMM_DI():
-
-    def __init__(
-            self,
-            order=3,
-            smoothing=None,
-            count_delim='\t',
-            sequence_delim='*_*',
-            sequence_beg='<s>',
-            sequence_end='</s>'):
-        # N-gramm size
-        self.order = order
-        if self.order < 1 or self.order > 5:
-            self.order = 1
-        # smoothing vector (must be of length self.order + 2)
-        self.smoothing = smoothing
-        # counts delimeter (e.g. label N-gram<TAB>count)
-        self.count_delim = count_delim
-        # sequence (e.g. sentences) delimeter
-        self.sequence_delim = sequence_delim
-        # sequence start and end labels
-        self.sequence_beg = sequence_beg
-        self.sequence_end = sequence_end
-        # state transistion table
-        self.transitions = {}
-        # state-observation table
-        self.emissions = {}
-        # vocabulary of states
-        self.states = {}
-        # vocabulary of observations
-        self.observations = {}
-
-    def load_model(self, model):
-        ''' load a model from a file '''
-        lines = open(model, 'r').readlines()
-        # get the model's order
-        self.order = int(lines[0].strip())
-        # get smoothing vector - space separated
-        self.smoothing = [float(lmb) for lmb in lines[1].strip().split()]
-        # get the count delimiter (it supposed to be in quotes,
-        # hence trimming one symbol from each side
-        self.count_delim = lines[2].strip()[1:-1]
-        # get sequence delimiter (again quotes trimming)
-        self.sequence_delim = lines[3].strip()[1:-1]
-        # get sequence beginning label (start state, default is '<s>')
-        self.sequence_beg = lines[4].strip()[1:-1]
-        # get sequence ending label (end state, default is '</s>')
-        self.sequence_end = lines[5].strip()[1:-1]
-        # get number of transitions
-        N = int(lines[6].strip())
-        for l in lines[7:7+N]:
-            [transition, mle] = l.strip().split(self.count_delim)
-            for state in transition.split():
-                if state not in [self.sequence_beg, self.sequence_end]:
-                    self.states[state] = 1
-            self.transitions[tuple(transition.split())] = float(mle)
-        # get number of state-observation pairs
-        M = int(lines[7+N].strip())
-        for i, line in enumerate(lines[8+N: 8+N+M]):
-            [emission, mle] = line.strip().split(self.count_delim)
-            tup = tuple(emission.split(' '))
-            if len(tup) < 2:
-                raise ValueError('Error loading model.\
-                                 Line {}: too few state,\
-                                 observation parameters'.format(i+7+N))
-            elif len(tup) > 2:
-                if len(tup) == 3 and not ''.join(tup[-2:]):
-                    tup = [tup[0], ' ']
-                else:
-                    raise ValueError('Error loading model.\
-                                     Line {}: consider removing spaces from\
-                                     states or observations'.format(i+7+N))
-            self.emissions[tup] = float(mle)
-
-    def save_model(self, model):
-        ''' load a model to a file '''
-        fd = open(model, 'w')
-        # zero-th line contains a single integer - the order of the model
-        fd.write(f'{self.order}\n')
-        # first line contains a single float - smoothing coefficient
-        # (between 0 and 1)
-        fd.write(f"{' '.join([str(lmb) for lmb in self.smoothing])}\n")
-        # second line contains count delimiter enclosed into quotation marks
-        fd.write(f'"{self.count_delim}"\n')
-        # third line contains sequence delimiter enclosed into quotation marks
-        fd.write(f'"{self.sequence_delim}"\n')
-        # fourth line contains sequence beginning label
-        # enclosed into quotation marks
-        fd.write(f'"{self.sequence_beg}"\n')
-        # fifth line contains sequence ending label
-        # enclosed into quotation marks
-        fd.write(f'"{self.sequence_end}"\n')
-        # sixth line contains a single integer N -
-        # number of state transition N-grams
-        fd.write(f'{len(self.transitions)}\n')
-        # next N lines contain state transition ngrams and
-        # their frequences (MLE) delimitered by the count delimiter
-        for transition, mle in sorted(
-                self.transitions.items(),
-                key=lambda x: x[1], reverse=True):
-            fd.write(f"{' '.join(transition)}{self.count_delim}{mle:1.20f}\n")
-        # next line contains a single integer M -
-        # number of state-observation pairs
-        fd.write(f'{len(self.emissions.values())}\n')
-        # next M lines contain state state-observation pairs and
-        # their frequences (MLE) delimitered by the count delimiter
-        for emission, mle in sorted(
-                self.emissions.items(),
-                key=lambda x: x[1], reverse=True):
-            fd.write(f"{' '.join(emission)}{self.count_delim}{mle:1.20f}\n")
-
-    def train(
-            self, trainfile,
-            order=3,
-            count_delim='\t',
-            sequence_delim='*_*'):
-        # N-gramm size
-        self.order = int(order)
-        if self.order < 1 or self.order > 5:
-            self.order = 1
-        # smoothing vector
-        self.smoothing = (self.order + 2)*[0.0]
-        # counts delimeter (e.g. label N-gram<TAB>count)
-        self.count_delim = count_delim
-        # sequence (e.g. sentences) delimeter
-        self.sequence_delim = sequence_delim
-        # state transistion table
-        self.transitions = {}
-        # state-observation table
-        self.emissions = {}
-        # vocabulary of states
-        self.states = {}
-        # vocabulary of observations
-        self.observations = {}
-        # read in the data and obtain counts
-        transition_counts = {}
-        emission_counts = {}
-        input_length = 0.0
-        buff = (self.order-1)*[self.sequence_beg]
-        for line in open(trainfile, 'r').readlines():
-            if not line.strip():
-                continue
-            input_length += 1
-            # end of current sequence -
-            # add sequence final markers and calc resulting transitions
-            if line.strip() == self.sequence_delim:
-                if self.order < 2:
-                    continue
-                for i in range(self.order - 1):
-                    if buff:
-                        ngrm = buff + [self.sequence_end]
-                        for j in range(len(ngrm)):
-                            pfx = tuple(ngrm[:len(ngrm)-j])
-                            transition_counts[pfx] = transition_counts.get(
-                                    pfx, 0.0) + 1
-                    buff = buff[1:] + [self.sequence_end]
-                buff = (self.order-1)*[self.sequence_beg]
-                continue
-            # get an observation-state pair
-            [observ, state] = line.rstrip().split(self.count_delim)
-            # update observations vocabulary
-            self.observations[observ] = 1
-            # update states vocabulary
-            if state not in [self.sequence_beg, self.sequence_end]:
-                self.states[state] = 1
-            # count transistions
-            ngrm = buff + [state]
-            for i in range(len(ngrm)):
-                pfx = tuple(ngrm[:len(ngrm)-i])
-                transition_counts[pfx] = transition_counts.get(pfx, 0.0) + 1
-            # count emissions
-            emission_counts[state, observ] = emission_counts.get(
-                    (state, observ), 0.0) + 1
-            # update buffer
-            if buff:
-                buff = buff[1:] + [state]
-
-        # compute MLEs and smoothing coeffcients for transitions
-        lambdas = self.order*[0.0]
-        for transition in transition_counts:
-            if len(transition) < self.order:
-                continue
-            deleted = []
-            for i in range(len(transition)):
-                ngram = tuple(transition[:len(transition)-i])
-                pfx = tuple(transition[:len(transition)-i-1])
-                # calc mle
-                self.transitions[ngram] = transition_counts.get(
-                        ngram, 0.0)
-                self.transitions[ngram] /= transition_counts.get(
-                        pfx, input_length)
-                # calc deleted mle
-                if transition_counts.get(pfx, input_length) - 1 < 1:
-                    deleted.insert(0, 0)
-                else:
-                    deleted.insert(0, transition_counts.get(
-                            ngram, 0.0) - 1)
-                    deleted[0] /= (transition_counts.get(
-                            pfx, input_length) - 1)
-            # adjust smoothing coefficients
-            lambdas[deleted.index(
-                    max(deleted))] += transition_counts[transition]
-        # normalize and save smoothing coeffcients
-        for i, lmb in enumerate(lambdas):
-            self.smoothing[i] = lmb / sum(lambdas)
-
-        # compute MLEs and smoothing coeffcients for emissions
-        lambdas = 2*[0.0]
-        for emission, count in emission_counts.items():
-            [state, observ] = emission
-            # calc mle
-            self.emissions[emission] = count / transition_counts.get(
-                    (state, ), count)
-            # calc deleted mle
-            if input_length > 1:
-                deleted[0] = (transition_counts.get(
-                        (state, ), count) - 1) / (input_length - 1)
-            else:
-                deleted[0] = 0
-            if transition_counts.get((state, ), count) > 1:
-                deleted[1] = (count - 1) / (
-                        transition_counts.get((state, ), count) - 1)
-            else:
-                deleted[1] = 0
-            deleted[1] = count - 1
-            deleted[1] /= transition_counts.get((state, ), count) - 1
-            deleted[1] = deleted[1] or 0
-            lambdas[1 - int(deleted[0] > deleted[1])] += count
-        # normalize and save smoothing coeffcients
-        for i, lmb in enumerate(lambdas):
-            self.smoothing[self.order+i] = lmb/sum(lambdas)
-
-    def generate(self, observations):
-        '''
-        viterbi decoder
-        '''
-        def smoothed_emission(state, observ):
-            if state == self.sequence_end:
-                return 1.0
-            ret = self.smoothing[self.order] * self.emissions.get(
-                    (state, observ), 0)
-            ret += self.smoothing[self.order+1] * self.transitions.get(
-                    state, 0)
-            return ret
-
-        def smoothed_transition(states):
-            ret = []
-            for i in range(self.order):
-                ret.append(self.smoothing[i] * self.transitions.get(
-                        states[:i + 1], 0))
-            return sum(ret)
-
-        def backtrack(path):
-            ret = []
-            curstate = self.sequence_end
-            for e in reversed(path):
-                curstate = e[curstate]
-                ret.insert(0, curstate)
-            return ret
-
-        ret = []
-        # separate procedure for unigrams
-        if self.order < 2:
-            for o in observations:
-                maxlike = [float('-inf'), None]
-                for s in self.states:
-                    like = smoothed_emission(s, o)
-                    if like > maxlike[0]:
-                        maxlike = [like, s]
-                ret.append(maxlike[1])
-            return ret
-
-        # backpointers
-        path = []
-        # probabilities at previous and current steps
-        prevporbs = {self.sequence_beg: math.log(1)}
-        # states prefix
-        state_pfx = (self.order-1) * [[self.sequence_beg]]
-        # logarithm at zero
-        LOGZERO = -1000
-        for observ in observations + [self.sequence_end]:
-            path.append({})
-            currporbs = {}
-            for state in (observ == self.sequence_end
-                          and [self.sequence_end] or self.states):
-                maxlogprob = float('-inf')
-                for pfx in itertools.product(*tuple(state_pfx)):
-                    tr_prob = smoothed_transition(pfx + (state, ))
-                    em_prob = smoothed_emission(state, observ)
-                    pp = prevporbs[pfx[-1]]
-                    pp += tr_prob and math.log(tr_prob) or LOGZERO
-                    pp += em_prob and math.log(em_prob) or LOGZERO
-                    if maxlogprob < pp:
-                        maxlogprob = pp
-                        path[-1][state] = pfx[-1]
-                currporbs[state] = maxlogprob
-            state_pfx = state_pfx[1:] + [self.states.keys()]
-            prevporbs = {k: v for k, v in currporbs.items()}
-        return backtrack(path[1:])
+#  -*- coding: UTF-8 -*-
+from __future__ import division
+import array
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import sys
+
+# binary model file signature
+BINARY_MAGIC = b'KZHMMDI2'
+
+
+def count_shard(args):
+    ''' count a shard of training lines in a worker process '''
+    [params, lines] = args
+    return HMM_DI(**params).count(lines)
+
+
+# HMM with deleted interpolation
+class HMM_DI():
+
+    def __init__(
+            self,
+            order=3,
+            smoothing=None,
+            count_delim='\t',
+            sequence_delim='*_*',
+            sequence_beg='<s>',
+            sequence_end='</s>',
+            compiled=True,
+            keep_counts=False):
+        # N-gramm size
+        self.order = order
+        if self.order < 1 or self.order > 5:
+            self.order = 1
+        # smoothing vector (must be of length self.order + 2)
+        self.smoothing = smoothing
+        # counts delimeter (e.g. label N-gram<TAB>count)
+        self.count_delim = count_delim
+        # sequence (e.g. sentences) delimeter
+        self.sequence_delim = sequence_delim
+        # sequence start and end labels
+        self.sequence_beg = sequence_beg
+        self.sequence_end = sequence_end
+        # state transistion table and state-observation table (None while
+        # only their interned copies exist, see the transitions property)
+        self.transition_table = {}
+        self.emission_table = {}
+        # vocabulary of states
+        self.states = {}
+        # vocabulary of observations
+        self.observations = {}
+        # keep counts after training, so that the model can be updated
+        # with new data (see the update method) and saved with them
+        self.keep_counts = keep_counts
+        # transition and emission counts, and number of input lines
+        # (None if counts are not kept)
+        self.transition_counts = None
+        self.emission_counts = None
+        self.input_length = 0.0
+        # compiled mode: build decoding tables on load/train and decode
+        # with them (otherwise the reference decoder is used)
+        self.compiled = compiled
+        # compiled decoding tables (see the compile method):
+        # state labels by integer id, with the sequence start and end
+        # labels appended after the model states (and followed by other
+        # labels of the model tables, if any)
+        self.labels = []
+        # interned model tables: label N-gram lengths, label ids and MLEs
+        # of transitions; (label id, observation id) pairs and MLEs
+        # of emissions
+        self.interned_transitions = None
+        self.interned_emissions = None
+        # binary model file the tables are mapped from (see load_binary)
+        self.mapped_file = None
+        # last label ids of reachable histories per decoding step
+        self.history_labels = []
+        # smoothed log transitions of reachable label N-grams, per
+        # decoding step a flat array of rows per label id (see
+        # transition_row), and views of the rows by step and label id
+        self.transition_arrays = []
+        self.log_transitions = []
+        # best log transitions and their first history indices per
+        # decoding step, in rows per label id indexed by the last label id
+        # of the history (-inf and -1 if no history ends with it), over all
+        # reachable label N-grams and over the ones seen in the transition
+        # table (for the beam decoder), and views of the rows by step
+        # and label id
+        self.label_transitions = []
+        self.seen_label_transitions = []
+        self.label_rows = []
+        self.seen_label_rows = []
+        # integer ids of known observations (unseen observations get
+        # the id following the known ones)
+        self.observation_ids = {}
+        # smoothed log emissions, a flat array of rows of label id indexed
+        # values per observation id (the last one for unseen observations,
+        # see emission_row)
+        self.log_emissions = array.array('d')
+        # best label id per observation id for unigram models
+        self.unigram_labels = array.array('i')
+
+    def load_model(self, model):
+        ''' load a model from a file (text or binary, see save_binary) '''
+        with open(model, 'rb') as fd:
+            # any version of the binary format
+            if fd.read(len(BINARY_MAGIC) - 1) == BINARY_MAGIC[:-1]:
+                return self.load_binary(model)
+        lines = open(model, 'r').readlines()
+        # get the model's order
+        self.order = int(lines[0].strip())
+        # get smoothing vector - space separated
+        self.smoothing = [float(lmb) for lmb in lines[1].strip().split()]
+        # get the count delimiter (it supposed to be in quotes,
+        # hence trimming one symbol from each side
+        self.count_delim = lines[2].strip()[1:-1]
+        # get sequence delimiter (again quotes trimming)
+        self.sequence_delim = lines[3].strip()[1:-1]
+        # get sequence beginning label (start state, default is '<s>')
+        self.sequence_beg = lines[4].strip()[1:-1]
+        # get sequence ending label (end state, default is '</s>')
+        self.sequence_end = lines[5].strip()[1:-1]
+        # get number of transitions
+        N = int(lines[6].strip())
+        for l in lines[7:7+N]:
+            [transition, mle] = l.strip().split(self.count_delim)
+            for state in transition.split():
+                if state not in [self.sequence_beg, self.sequence_end]:
+                    self.states[state] = 1
+            self.transitions[tuple(transition.split())] = float(mle)
+        # get number of state-observation pairs
+        M = int(lines[7+N].strip())
+        for i, line in enumerate(lines[8+N: 8+N+M]):
+            [emission, mle] = line.strip().split(self.count_delim)
+            tup = tuple(emission.split(' '))
+            if len(tup) < 2:
+                raise ValueError('Error loading model.\
+                                 Line {}: too few state,\
+                                 observation parameters'.format(i+7+N))
+            elif len(tup) > 2:
+                if len(tup) == 3 and not ''.join(tup[-2:]):
+                    tup = [tup[0], ' ']
+                else:
+                    raise ValueError('Error loading model.\
+                                     Line {}: consider removing spaces from\
+                                     states or observations'.format(i+7+N))
+            self.emissions[tup] = float(mle)
+        # get counts, if the model was saved with them
+        pos = 8+N+M
+        if len(lines) > pos and lines[pos].strip():
+            self.input_length = float(lines[pos].strip())
+            K = int(lines[pos+1].strip())
+            self.transition_counts = {}
+            for line in lines[pos+2:pos+2+K]:
+                [transition, cnt] = line.strip().split(self.count_delim)
+                self.transition_counts[
+                        tuple(transition.split())] = float(cnt)
+            L = int(lines[pos+2+K].strip())
+            self.emission_counts = {}
+            for line in lines[pos+3+K:pos+3+K+L]:
+                [emission, cnt] = line.strip().split(self.count_delim)
+                self.emission_counts[
+                        tuple(emission.split(' ', 1))] = float(cnt)
+            self.keep_counts = True
+        # build decoding tables
+        if self.compiled:
+            self.compile()
+
+    def save_model(self, model):
+        ''' load a model to a file '''
+        fd = open(model, 'w')
+        # zero-th line contains a single integer - the order of the model
+        fd.write(f'{self.order}\n')
+        # first line contains a single float - smoothing coefficient
+        # (between 0 and 1)
+        fd.write(f"{' '.join([str(lmb) for lmb in self.smoothing])}\n")
+        # second line contains count delimiter enclosed into quotation marks
+        fd.write(f'"{self.count_delim}"\n')
+        # third line contains sequence delimiter enclosed into quotation marks
+        fd.write(f'"{self.sequence_delim}"\n')
+        # fourth line contains sequence beginning label
+        # enclosed into quotation marks
+        fd.write(f'"{self.sequence_beg}"\n')
+        # fifth line contains sequence ending label
+        # enclosed into quotation marks
+        fd.write(f'"{self.sequence_end}"\n')
+        # sixth line contains a single integer N -
+        # number of state transition N-grams
+        fd.write(f'{len(self.transitions)}\n')
+        # next N lines contain state transition ngrams and
+        # their frequences (MLE) delimitered by the count delimiter
+        for transition, mle in sorted(
+                self.transitions.items(),
+                key=lambda x: x[1], reverse=True):
+            fd.write(f"{' '.join(transition)}{self.count_delim}{mle:1.20f}\n")
+        # next line contains a single integer M -
+        # number of state-observation pairs
+        fd.write(f'{len(self.emissions.values())}\n')
+        # next M lines contain state state-observation pairs and
+        # their frequences (MLE) delimitered by the count delimiter
+        for emission, mle in sorted(
+                self.emissions.items(),
+                key=lambda x: x[1], reverse=True):
+            fd.write(f"{' '.join(emission)}{self.count_delim}{mle:1.20f}\n")
+        if self.transition_counts is None:
+            return
+        # optional counts section (see keep_counts): a line with a single
+        # integer - number of input lines, then a line with a single
+        # integer K - number of transition N-grams, followed by K lines of
+        # N-grams and their counts, and a line with a single integer L -
+        # number of state-observation pairs, followed by L lines of pairs
+        # and their counts (models without counts end before this section)
+        fd.write(f'{self.input_length:.0f}\n')
+        fd.write(f'{len(self.transition_counts)}\n')
+        for transition, cnt in self.transition_counts.items():
+            fd.write(f"{' '.join(transition)}{self.count_delim}{cnt:.0f}\n")
+        fd.write(f'{len(self.emission_counts)}\n')
+        for emission, cnt in self.emission_counts.items():
+            fd.write(f"{' '.join(emission)}{self.count_delim}{cnt:.0f}\n")
+
+    def save_binary(self, model):
+        '''
+        save a model to a binary file: a JSON header with parameters,
+        vocabularies and the names, type codes and sizes of the arrays
+        that follow it, 8-byte aligned - the interned model tables and
+        the compiled decoding tables (see compile), then the interned
+        counts, if the model keeps them
+        '''
+        if not self.compiled or self.interned_transitions is None:
+            self.compile()
+        arrays = [
+                ('transition_lens', self.interned_transitions[0]),
+                ('transition_ids', self.interned_transitions[1]),
+                ('transition_probs', self.interned_transitions[2]),
+                ('emission_ids', self.interned_emissions[0]),
+                ('emission_probs', self.interned_emissions[1]),
+                ('vocabulary', array.array('i', [
+                        self.observation_ids[observ]
+                        for observ in self.observations])),
+                ('log_emissions', self.log_emissions),
+                ('unigram_labels', self.unigram_labels)]
+        for step in range(len(self.history_labels)):
+            arrays += [
+                    (f'history_labels.{step}', self.history_labels[step]),
+                    (f'log_transitions.{step}', self.transition_arrays[step]),
+                    (f'label_transitions.{step}',
+                     self.label_transitions[step][0]),
+                    (f'label_histories.{step}',
+                     self.label_transitions[step][1]),
+                    (f'seen_label_transitions.{step}',
+                     self.seen_label_transitions[step][0]),
+                    (f'seen_label_histories.{step}',
+                     self.seen_label_transitions[step][1])]
+        header = {
+                'byteorder': sys.byteorder,
+                'order': self.order,
+                'smoothing': self.smoothing,
+                'count_delim': self.count_delim,
+                'sequence_delim': self.sequence_delim,
+                'sequence_beg': self.sequence_beg,
+                'sequence_end': self.sequence_end,
+                'states': len(self.states),
+                'labels': self.labels,
+                'observations': list(self.observation_ids),
+                'input_length': self.input_length}
+        if self.transition_counts is not None:
+            # labels and observations of the counts missing
+            # from the model vocabularies follow them
+            label_ids = {label: i for i, label in enumerate(self.labels)}
+            observation_ids = dict(self.observation_ids)
+            [transitions, emissions] = self.intern(
+                    self.transition_counts, self.emission_counts,
+                    label_ids, observation_ids)
+            header['count_labels'] = list(label_ids)[len(self.labels):]
+            header['count_observations'] = list(
+                    observation_ids)[len(self.observation_ids):]
+            arrays += [
+                    ('transition_count_lens', transitions[0]),
+                    ('transition_count_ids', transitions[1]),
+                    ('transition_counts', transitions[2]),
+                    ('emission_count_ids', emissions[0]),
+                    ('emission_counts', emissions[1])]
+        header['arrays'] = [[name, a.format if isinstance(
+                a, memoryview) else a.typecode, len(a)] for name, a in arrays]
+        header = json.dumps(header).encode('utf-8')
+        header += (-len(header) % 8) * b' '
+        # write a new file and move it over the old one, which this or
+        # other processes may have mapped (see load_binary) - truncating
+        # it in place would pull the pages from under them
+        tmp = f'{model}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as fd:
+                fd.write(BINARY_MAGIC)
+                fd.write(len(header).to_bytes(8, 'little'))
+                fd.write(header)
+                for name, a in arrays:
+                    data = a.tobytes()
+                    fd.write(data + (-len(data) % 8) * b'\0')
+            os.replace(tmp, model)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def load_binary(self, model):
+        '''
+        load a model from a binary file (see save_binary): the compiled
+        tables are views of the memory-mapped file, which stays mapped
+        (unless it has a different byte order, then they are copied),
+        so that loading reads little more than the header and processes
+        loading the same file share its pages; the transitions and
+        emissions dictionaries are built on first access
+        '''
+        with open(model, 'rb') as fd:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(mm)
+        try:
+            [header, arrays] = self.read_binary(buf)
+        except BaseException:
+            buf.release()
+            mm.close()
+            raise
+        self.order = header['order']
+        self.smoothing = header['smoothing']
+        self.count_delim = header['count_delim']
+        self.sequence_delim = header['sequence_delim']
+        self.sequence_beg = header['sequence_beg']
+        self.sequence_end = header['sequence_end']
+        nstates = header['states']
+        self.labels = header['labels']
+        self.states = {label: 1 for label in self.labels[:nstates]}
+        observs = header['observations']
+        self.observation_ids = {observ: i for i, observ in enumerate(observs)}
+        self.observations = {
+                observs[i]: 1 for i in arrays['vocabulary']}
+        self.interned_transitions = [arrays['transition_lens'],
+                                     arrays['transition_ids'],
+                                     arrays['transition_probs']]
+        self.interned_emissions = [arrays['emission_ids'],
+                                   arrays['emission_probs']]
+        self.transition_table = None
+        self.emission_table = None
+        self.log_emissions = arrays['log_emissions']
+        self.unigram_labels = arrays['unigram_labels']
+        steps = range(self.order if self.order > 1 else 0)
+        self.history_labels = [
+                arrays[f'history_labels.{step}'] for step in steps]
+        self.transition_arrays = [
+                arrays[f'log_transitions.{step}'] for step in steps]
+        self.label_transitions = [
+                [arrays[f'label_transitions.{step}'],
+                 arrays[f'label_histories.{step}']] for step in steps]
+        self.seen_label_transitions = [
+                [arrays[f'seen_label_transitions.{step}'],
+                 arrays[f'seen_label_histories.{step}']] for step in steps]
+        self.index_rows()
+        if 'transition_counts' in arrays:
+            labels = self.labels + header['count_labels']
+            observs = observs + header['count_observations']
+            self.transition_counts = self.get_transition_table(
+                    [arrays['transition_count_lens'],
+                     arrays['transition_count_ids'],
+                     arrays['transition_counts']], labels)
+            self.emission_counts = self.get_emission_table(
+                    [arrays['emission_count_ids'],
+                     arrays['emission_counts']], labels, observs)
+            self.input_length = header['input_length']
+            self.keep_counts = True
+        # pickled as the file name (see __getstate__)
+        self.mapped_file = os.path.abspath(model)
+
+    def read_binary(self, buf):
+        '''
+        header and arrays (by name) of a binary model file (see
+        save_binary), checking that they describe a consistent model
+        '''
+        if bytes(buf[:len(BINARY_MAGIC) - 1]) != BINARY_MAGIC[:-1]:
+            raise ValueError('Error loading model.\
+                             Not a binary HMM_DI model file')
+        if bytes(buf[:len(BINARY_MAGIC)]) != BINARY_MAGIC:
+            raise ValueError('Error loading model.\
+                             Unsupported binary model version')
+        pos = len(BINARY_MAGIC) + 8
+        size = int.from_bytes(buf[len(BINARY_MAGIC):pos], 'little')
+        arrays = {}
+        try:
+            header = json.loads(bytes(buf[pos:pos+size]).decode('utf-8'))
+            order, nstates = int(header['order']), int(header['states'])
+            nlabels, nobs = nstates + 2, len(header['observations'])
+            swap = {'little': False, 'big': True}[
+                    header['byteorder']] != (sys.byteorder == 'big')
+            pos += size
+            for name, code, size in header['arrays']:
+                a = array.array(code)
+                nbytes = size * a.itemsize
+                if code not in ['B', 'i', 'd'] or size < 0 or (
+                        pos + nbytes > len(buf)):
+                    raise ValueError('Error loading model.\
+                                     Binary model file is truncated')
+                if swap:
+                    a.frombytes(buf[pos:pos+nbytes])
+                    a.byteswap()
+                else:
+                    a = buf[pos:pos+nbytes].cast(code)
+                arrays[name] = a
+                pos += nbytes + (-nbytes % 8)
+            # expected array sizes
+            sizes = {'log_emissions': (nobs + 1) * nlabels if order > 1
+                     else 0,
+                     'unigram_labels': nobs + 1 if order < 2 else 0}
+            for step in range(order if order > 1 else 0):
+                nhist = nstates ** step
+                sizes[f'history_labels.{step}'] = nhist
+                sizes[f'log_transitions.{step}'] = (nstates + 1) * nhist
+                for name in ['label_transitions', 'label_histories',
+                             'seen_label_transitions',
+                             'seen_label_histories']:
+                    sizes[f'{name}.{step}'] = (nstates + 1) * nlabels
+            if header['labels'][nstates:nlabels] != [
+                    header['sequence_beg'], header['sequence_end']] or any(
+                    len(arrays[name]) != size
+                    for name, size in sizes.items()):
+                raise ValueError('Error loading model.\
+                                 Inconsistent binary model tables')
+            # ids used at load or by the decoders
+            self.check_ids(arrays['vocabulary'], 0, nobs)
+            self.check_ids(arrays['unigram_labels'], -1, nstates)
+            for step in range(order if order > 1 else 0):
+                self.check_ids(arrays[f'history_labels.{step}'], 0, nlabels)
+        except (KeyError, TypeError, ValueError, OverflowError) as e:
+            for a in arrays.values():
+                if isinstance(a, memoryview):
+                    a.release()
+            if str(e).startswith('Error loading model.'):
+                raise
+            raise ValueError('Error loading model.\
+                             Malformed binary model header')
+        return header, arrays
+
+    def check_ids(self, ids, lo, hi):
+        ''' raise ValueError unless all ids are in [lo, hi) '''
+        if len(ids) and (min(ids) < lo or max(ids) >= hi):
+            raise ValueError('Error loading model.\
+                             Label or observation id out of range')
+
+    def train(
+            self, trainfile,
+            order=3,
+            count_delim='\t',
+            sequence_delim='*_*',
+            processes=1,
+            shard_size=100000):
+        '''
+        train a model on a file of observation<count_delim>state lines,
+        sequences being separated by sequence_delim lines; the file is
+        read in shards of about [shard_size] lines (cut at sequence
+        delimiters), which are counted by [processes] worker processes
+        '''
+        # N-gramm size
+        self.order = int(order)
+        if self.order < 1 or self.order > 5:
+            self.order = 1
+        # counts delimeter (e.g. label N-gram<TAB>count)
+        self.count_delim = count_delim
+        # sequence (e.g. sentences) delimeter
+        self.sequence_delim = sequence_delim
+        # vocabulary of states
+        self.states = {}
+        # vocabulary of observations
+        self.observations = {}
+        # read in the data and obtain counts
+        counts = [{}, {}, 0.0]
+        with open(trainfile, 'r') as fd:
+            self.add_counts(counts, fd, processes, shard_size)
+        if self.keep_counts:
+            [self.transition_counts, self.emission_counts,
+             self.input_length] = counts
+        self.estimate(*counts)
+
+    def update(self, trainfile, processes=1, shard_size=100000):
+        '''
+        add training data (a file name or an iterable of lines in the
+        format of train) to a model that keeps its counts and re-estimate
+        it; the result is the same as training on all of the data at once
+        (given that the earlier data ends with a sequence delimiter)
+        '''
+        if self.transition_counts is None:
+            raise ValueError('Error updating model.\
+                             Model has no counts: train it with\
+                             keep_counts=True or load a model saved with\
+                             counts')
+        counts = [self.transition_counts, self.emission_counts,
+                  self.input_length]
+        if isinstance(trainfile, str):
+            with open(trainfile, 'r') as fd:
+                self.add_counts(counts, fd, processes, shard_size)
+        else:
+            self.add_counts(counts, trainfile, processes, shard_size)
+        self.input_length = counts[2]
+        self.estimate(*counts)
+
+    def add_counts(self, counts, lines, processes=1, shard_size=100000):
+        '''
+        count training lines in shards (see train) and add the result to
+        [counts] - a list of transition counts, emission counts and
+        number of input lines - and to the vocabularies of the model
+        '''
+        [transition_counts, emission_counts, input_length] = counts
+        shards = self.get_shards(lines, shard_size)
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            shard_counts = pool.imap(count_shard, (
+                    (self.get_params(), shard) for shard in shards))
+        else:
+            pool = None
+            shard_counts = (self.count(shard) for shard in shards)
+        # merge counts in input order
+        for [trs, ems, length, states, observs] in shard_counts:
+            for ngrm, cnt in trs.items():
+                transition_counts[ngrm] = transition_counts.get(
+                        ngrm, 0.0) + cnt
+            for emission, cnt in ems.items():
+                emission_counts[emission] = emission_counts.get(
+                        emission, 0.0) + cnt
+            input_length += length
+            self.states.update(states)
+            self.observations.update(observs)
+        if pool:
+            pool.close()
+            pool.join()
+        counts[2] = input_length
+
+    def get_params(self):
+        ''' constructor parameters of the model '''
+        return {'order': self.order,
+                'smoothing': self.smoothing,
+                'count_delim': self.count_delim,
+                'sequence_delim': self.sequence_delim,
+                'sequence_beg': self.sequence_beg,
+                'sequence_end': self.sequence_end,
+                'compiled': self.compiled,
+                'keep_counts': self.keep_counts}
+
+    def get_shards(self, lines, shard_size):
+        '''
+        split an iterable of training lines into lists of at least
+        [shard_size] lines, cut after sequence delimiters
+        '''
+        shard = []
+        for line in lines:
+            shard.append(line)
+            if len(shard) >= shard_size and (
+                    line.strip() == self.sequence_delim):
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+
+    def count(self, lines):
+        '''
+        count transitions and emissions in training lines, returns
+        transition counts, emission counts, number of input lines,
+        and vocabularies of states and observations
+        '''
+        transition_counts = {}
+        emission_counts = {}
+        input_length = 0.0
+        states = {}
+        observations = {}
+        buff = (self.order-1)*[self.sequence_beg]
+        for line in lines:
+            if not line.strip():
+                continue
+            input_length += 1
+            # end of current sequence -
+            # add sequence final markers and calc resulting transitions
+            if line.strip() == self.sequence_delim:
+                if self.order < 2:
+                    continue
+                for i in range(self.order - 1):
+                    if buff:
+                        ngrm = buff + [self.sequence_end]
+                        for j in range(len(ngrm)):
+                            pfx = tuple(ngrm[:len(ngrm)-j])
+                            transition_counts[pfx] = transition_counts.get(
+                                    pfx, 0.0) + 1
+                    buff = buff[1:] + [self.sequence_end]
+                buff = (self.order-1)*[self.sequence_beg]
+                continue
+            # get an observation-state pair
+            [observ, state] = line.rstrip().split(self.count_delim)
+            # update observations vocabulary
+            observations[observ] = 1
+            # update states vocabulary
+            if state not in [self.sequence_beg, self.sequence_end]:
+                states[state] = 1
+            # count transistions
+            ngrm = buff + [state]
+            for i in range(len(ngrm)):
+                pfx = tuple(ngrm[:len(ngrm)-i])
+                transition_counts[pfx] = transition_counts.get(pfx, 0.0) + 1
+            # count emissions
+            emission_counts[state, observ] = emission_counts.get(
+                    (state, observ), 0.0) + 1
+            # update buffer
+            if buff:
+                buff = buff[1:] + [state]
+        return [transition_counts, emission_counts, input_length,
+                states, observations]
+
+    def estimate(self, transition_counts, emission_counts, input_length):
+        ''' compute MLEs and smoothing coefficients from counts '''
+        # smoothing vector
+        self.smoothing = (self.order + 2)*[0.0]
+        # state transistion table
+        self.transitions = {}
+        # state-observation table
+        self.emissions = {}
+        # compute MLEs and smoothing coeffcients for transitions
+        lambdas = self.order*[0.0]
+        # deleted MLEs of N-grams (each N-gram is estimated only once)
+        deleted_mles = {}
+        for transition in transition_counts:
+            if len(transition) < self.order:
+                continue
+            deleted = []
+            for i in range(len(transition)):
+                ngram = tuple(transition[:len(transition)-i])
+                if ngram not in deleted_mles:
+                    pfx = tuple(transition[:len(transition)-i-1])
+                    # calc mle
+                    self.transitions[ngram] = transition_counts.get(
+                            ngram, 0.0)
+                    self.transitions[ngram] /= transition_counts.get(
+                            pfx, input_length)
+                    # calc deleted mle
+                    if transition_counts.get(pfx, input_length) - 1 < 1:
+                        deleted_mles[ngram] = 0
+                    else:
+                        deleted_mles[ngram] = transition_counts.get(
+                                ngram, 0.0) - 1
+                        deleted_mles[ngram] /= (transition_counts.get(
+                                pfx, input_length) - 1)
+                deleted.insert(0, deleted_mles[ngram])
+            # adjust smoothing coefficients
+            lambdas[deleted.index(
+                    max(deleted))] += transition_counts[transition]
+        # normalize and save smoothing coeffcients
+        for i, lmb in enumerate(lambdas):
+            self.smoothing[i] = lmb / sum(lambdas)
+
+        # compute MLEs and smoothing coeffcients for emissions
+        lambdas = 2*[0.0]
+        for emission, count in emission_counts.items():
+            [state, observ] = emission
+            # calc mle
+            self.emissions[emission] = count / transition_counts.get(
+                    (state, ), count)
+            # calc deleted mle
+            if input_length > 1:
+                deleted[0] = (transition_counts.get(
+                        (state, ), count) - 1) / (input_length - 1)
+            else:
+                deleted[0] = 0
+            if transition_counts.get((state, ), count) > 1:
+                deleted[1] = (count - 1) / (
+                        transition_counts.get((state, ), count) - 1)
+            else:
+                deleted[1] = 0
+            deleted[1] = count - 1
+            deleted[1] /= transition_counts.get((state, ), count) - 1
+            deleted[1] = deleted[1] or 0
+            lambdas[1 - int(deleted[0] > deleted[1])] += count
+        # normalize and save smoothing coeffcients
+        for i, lmb in enumerate(lambdas):
+            self.smoothing[self.order+i] = lmb/sum(lambdas)
+        # build decoding tables
+        if self.compiled:
+            self.compile()
+
+    def compile(self):
+        '''
+        intern the model tables and precompute smoothed log-probabilities
+        into tables indexed by integer label ids, so that decoding does no
+        smoothing, logarithms or tuple hashing (observations are mapped
+        to integer ids once, see get_observation_ids); in compiled mode the
+        interned tables are the only copy of the model, the transitions
+        and emissions dictionaries are rebuilt from them on access (see
+        the transitions property); must be called again if the model
+        tables are modified directly
+        '''
+        # logarithm at zero (same as in the reference decoder)
+        LOGZERO = -1000
+        # no transition
+        LOGMIN = float('-inf')
+        transitions = self.transitions
+        emissions = self.emissions
+
+        def logprob(prob):
+            return prob and math.log(prob) or LOGZERO
+
+        def smoothed_emission(state, observ):
+            prob = self.smoothing[self.order] * emissions.get(
+                    (state, observ), 0)
+            prob += self.smoothing[self.order+1] * transitions.get(
+                    state, 0)
+            return prob
+
+        nstates = len(self.states)
+        # label ids: model states, the sequence start and end labels, then
+        # any other labels of the tables (never decoded)
+        label_ids = {label: i for i, label in enumerate(list(self.states) + [
+                self.sequence_beg, self.sequence_end])}
+        # every known observation
+        observs = {observ: 1 for (state, observ) in emissions}
+        observs.update(self.observations)
+        self.observation_ids = {observ: i for i, observ in enumerate(observs)}
+        [self.interned_transitions, self.interned_emissions] = self.intern(
+                transitions, emissions, label_ids, self.observation_ids)
+        self.labels = list(label_ids)
+        self.mapped_file = None
+        self.history_labels = []
+        self.transition_arrays = []
+        self.log_transitions = []
+        self.label_transitions = []
+        self.seen_label_transitions = []
+        self.log_emissions = array.array('d')
+        self.unigram_labels = array.array('i')
+        # None for unseen observations
+        observs = list(observs) + [None]
+        if self.order < 2:
+            # labels do not depend on context - store the best one
+            # (-1 if there are no states)
+            for observ in observs:
+                maxlike = [float('-inf'), -1]
+                for state in range(nstates):
+                    like = smoothed_emission(self.labels[state], observ)
+                    if like > maxlike[0]:
+                        maxlike = [like, state]
+                self.unigram_labels.append(maxlike[1])
+        else:
+            self.compile_transitions(transitions, logprob, LOGMIN)
+            self.index_rows()
+            # emission rows for every observation,
+            # the end state emits with probability one
+            for observ in observs:
+                self.log_emissions.extend(
+                        logprob(smoothed_emission(state, observ))
+                        for state in self.labels[:nstates])
+                self.log_emissions.extend([LOGZERO, logprob(1.0)])
+        # the dictionaries are rebuilt from the interned tables when needed
+        if self.compiled:
+            self.transition_table = None
+            self.emission_table = None
+
+    def compile_transitions(self, transitions, logprob, LOGMIN):
+        '''
+        transition tables of the compiled decoder (see compile): flat
+        arrays per decoding step with a row for every model state and one
+        for the sequence end label (see transition_row)
+        '''
+        nstates = len(self.states)
+        nlabels = nstates + 2
+        beg, end = nstates, nstates + 1
+        # transitions for reachable label N-grams only: the first order-1
+        # steps have histories (all but the last label of an N-gram) that
+        # start with sequence beginning labels; per step keep last label
+        # ids of the histories and, per label id, the log transitions
+        # in the order the reference decoder enumerates histories
+        for nbeg in range(self.order - 1, -1, -1):
+            steps = nbeg * [[beg]] + (self.order - 1 - nbeg) * [
+                    range(nstates)]
+            histories = list(itertools.product(*steps))
+            self.history_labels.append(
+                    array.array('i', [ids[-1] for ids in histories]))
+            table = array.array('d')
+            best = [array.array('d', (nstates + 1) * nlabels * [LOGMIN]),
+                    array.array('i', (nstates + 1) * nlabels * [-1])]
+            seen = [array.array('d', (nstates + 1) * nlabels * [LOGMIN]),
+                    array.array('i', (nstates + 1) * nlabels * [-1])]
+            for row, state in enumerate(list(range(nstates)) + [end]):
+                for h, ids in enumerate(histories):
+                    ngram = tuple(self.labels[i] for i in ids + (state, ))
+                    prob = sum([self.smoothing[i] * transitions.get(
+                            ngram[:i + 1], 0) for i in range(self.order)])
+                    table.append(logprob(prob))
+                    tables = [best]
+                    if ngram in transitions:
+                        tables.append(seen)
+                    i = row * nlabels + ids[-1]
+                    for [probs, hists] in tables:
+                        if probs[i] < table[-1]:
+                            probs[i] = table[-1]
+                            hists[i] = h
+            self.transition_arrays.append(table)
+            self.label_transitions.append(best)
+            self.seen_label_transitions.append(seen)
+
+    def index_rows(self):
+        '''
+        views of the rows of the compiled transition tables by decoding
+        step and label id (None for the sequence start label)
+        '''
+        nstates = len(self.states)
+
+        def rows(table, size):
+            ret = [self.transition_row(table, state, size)
+                   for state in range(nstates + 2)]
+            ret[nstates] = None
+            return ret
+
+        self.log_transitions = [
+                rows(table, len(lasts)) for lasts, table in zip(
+                        self.history_labels, self.transition_arrays)]
+        # (log transitions, history indices) row pairs
+        self.label_rows = [
+                list(zip(rows(probs, nstates + 2), rows(hists, nstates + 2)))
+                for probs, hists in self.label_transitions]
+        self.seen_label_rows = [
+                list(zip(rows(probs, nstates + 2), rows(hists, nstates + 2)))
+                for probs, hists in self.seen_label_transitions]
+
+    def intern(self, transitions, emissions, label_ids, observation_ids):
+        '''
+        interned copies of a transition table (label N-gram lengths, label
+        ids and values) and of an emission table ((label id, observation
+        id) pairs and values), in the order of the dictionaries; labels
+        and observations missing from the id dictionaries are added
+        '''
+        lens, ids = array.array('B'), array.array('i')
+        for ngram in transitions:
+            lens.append(len(ngram))
+            ids.extend(label_ids.setdefault(label, len(label_ids))
+                       for label in ngram)
+        pairs = array.array('i')
+        for state, observ in emissions:
+            pairs.append(label_ids.setdefault(state, len(label_ids)))
+            pairs.append(observation_ids.setdefault(
+                    observ, len(observation_ids)))
+        return [[lens, ids, array.array('d', transitions.values())],
+                [pairs, array.array('d', emissions.values())]]
+
+    def get_transition_table(self, interned, labels):
+        '''
+        transition dictionary of an interned table (see intern)
+        '''
+        [lens, ids, probs] = interned
+        if len(lens) != len(probs) or sum(lens) != len(ids):
+            raise ValueError('Error loading model.\
+                             Inconsistent binary model tables')
+        self.check_ids(ids, 0, len(labels))
+        ret = {}
+        pos = 0
+        for size, prob in zip(lens, probs):
+            ret[tuple(labels[i] for i in ids[pos:pos+size])] = prob
+            pos += size
+        return ret
+
+    def get_emission_table(self, interned, labels, observs):
+        '''
+        emission dictionary of an interned table (see intern)
+        '''
+        [ids, probs] = interned
+        if len(ids) != 2 * len(probs):
+            raise ValueError('Error loading model.\
+                             Inconsistent binary model tables')
+        self.check_ids(ids[0::2], 0, len(labels))
+        self.check_ids(ids[1::2], 0, len(observs))
+        ret = {}
+        for i, prob in enumerate(probs):
+            ret[labels[ids[2*i]], observs[ids[2*i+1]]] = prob
+        return ret
+
+    def __getstate__(self):
+        # models mapped from a binary file are pickled as the file name,
+        # others without the row views (see __setstate__)
+        if self.mapped_file is not None:
+            return {'mapped_file': self.mapped_file,
+                    'compiled': self.compiled}
+        state = dict(self.__dict__)
+        state['log_transitions'] = []
+        state['label_rows'] = []
+        state['seen_label_rows'] = []
+        return state
+
+    def __setstate__(self, state):
+        if state.get('mapped_file') is not None:
+            self.__init__(compiled=state['compiled'])
+            self.load_binary(state['mapped_file'])
+            return
+        self.__dict__.update(state)
+        self.index_rows()
+
+    @property
+    def transitions(self):
+        '''
+        state transition table: label N-gram -> MLE (compiled models
+        rebuild it from the interned tables on first access, see compile)
+        '''
+        if self.transition_table is None:
+            self.transition_table = self.get_transition_table(
+                    self.interned_transitions, self.labels)
+        return self.transition_table
+
+    @transitions.setter
+    def transitions(self, table):
+        # the model no longer matches its binary file
+        self.mapped_file = None
+        self.transition_table = table
+
+    @property
+    def emissions(self):
+        '''
+        state-observation table: (label, observation) -> MLE (compiled
+        models rebuild it from the interned tables on first access)
+        '''
+        if self.emission_table is None:
+            self.emission_table = self.get_emission_table(
+                    self.interned_emissions, self.labels,
+                    list(self.observation_ids))
+        return self.emission_table
+
+    @emissions.setter
+    def emissions(self, table):
+        self.mapped_file = None
+        self.emission_table = table
+
+    def generate(self, observations):
+        '''
+        viterbi decoder
+        '''
+        if self.compiled and (self.log_transitions or self.unigram_labels):
+            observations = self.get_observation_ids(observations)
+            if self.order < 2:
+                labels = self.labels[:len(self.states)] + [None]
+                return [labels[self.unigram_labels[i]] for i in observations]
+            # backpointers
+            path = []
+            probs = self.start_probs()
+            for t, observ in enumerate(observations):
+                probs, pointers = self.step(probs, observ, t)
+                path.append(pointers)
+            return self.backtrack(
+                    path[1:], self.end_step(probs, len(observations)))
+
+        def smoothed_emission(state, observ):
+            if state == self.sequence_end:
+                return 1.0
+            ret = self.smoothing[self.order] * self.emissions.get(
+                    (state, observ), 0)
+            ret += self.smoothing[self.order+1] * self.transitions.get(
+                    state, 0)
+            return ret
+
+        def smoothed_transition(states):
+            ret = []
+            for i in range(self.order):
+                ret.append(self.smoothing[i] * self.transitions.get(
+                        states[:i + 1], 0))
+            return sum(ret)
+
+        def backtrack(path):
+            ret = []
+            curstate = self.sequence_end
+            for e in reversed(path):
+                curstate = e[curstate]
+                ret.insert(0, curstate)
+            return ret
+
+        ret = []
+        # separate procedure for unigrams
+        if self.order < 2:
+            for o in observations:
+                maxlike = [float('-inf'), None]
+                for s in self.states:
+                    like = smoothed_emission(s, o)
+                    if like > maxlike[0]:
+                        maxlike = [like, s]
+                ret.append(maxlike[1])
+            return ret
+
+        # backpointers
+        path = []
+        # probabilities at previous and current steps
+        prevporbs = {self.sequence_beg: math.log(1)}
+        # states prefix
+        state_pfx = (self.order-1) * [[self.sequence_beg]]
+        # logarithm at zero
+        LOGZERO = -1000
+        for observ in observations + [self.sequence_end]:
+            path.append({})
+            currporbs = {}
+            for state in (observ == self.sequence_end
+                          and [self.sequence_end] or self.states):
+                maxlogprob = float('-inf')
+                for pfx in itertools.product(*tuple(state_pfx)):
+                    tr_prob = smoothed_transition(pfx + (state, ))
+                    em_prob = smoothed_emission(state, observ)
+                    pp = prevporbs[pfx[-1]]
+                    pp += tr_prob and math.log(tr_prob) or LOGZERO
+                    pp += em_prob and math.log(em_prob) or LOGZERO
+                    if maxlogprob < pp:
+                        maxlogprob = pp
+                        path[-1][state] = pfx[-1]
+                currporbs[state] = maxlogprob
+            state_pfx = state_pfx[1:] + [self.states.keys()]
+            prevporbs = {k: v for k, v in currporbs.items()}
+        return backtrack(path[1:])
+
+    def generate_batch(self, batch):
+        '''
+        viterbi decoder for a batch of observation sequences, returns
+        a list of label lists (the sequences are decoded one by one)
+        '''
+        return [self.generate(list(observations)) for observations in batch]
+
+    def generate_stream(self, observations, window=1000):
+        '''
+        viterbi decoder for an unbounded iterable of observations, yields
+        labels as soon as they are final: once backpointers of all states
+        converge to a single earlier state, the path up to that state can
+        no longer change; the backpointer window is bounded by [window] -
+        if it fills up without convergence, the path to the currently best
+        state is committed (labels may then differ from the full decoder)
+        '''
+        if not (self.compiled and (
+                self.log_transitions or self.unigram_labels)):
+            for label in self.generate(list(observations)):
+                yield label
+            return
+        ids = self.observation_ids
+        unseen = len(ids)
+        if self.order < 2:
+            labels = self.labels[:len(self.states)] + [None]
+            for observ in observations:
+                yield labels[self.unigram_labels[ids.get(observ, unseen)]]
+            return
+        prevprobs = self.start_probs()
+        # backpointers of the positions that are not final yet
+        path = []
+        t = 0
+        for observ in observations:
+            prevprobs, pointers = self.step(
+                    prevprobs, ids.get(observ, unseen), t)
+            path.append(pointers)
+            t += 1
+            if len(path) < 2:
+                continue
+            # find the latest path position all current states go back to,
+            # survivors are the states at path position j-1
+            j = len(path) - 1
+            survivors = set(pointers)
+            while j > 1 and len(survivors) > 1:
+                j -= 1
+                survivors = {path[j][s] for s in survivors}
+            if len(survivors) == 1:
+                # path positions up to j-1 are final
+                for label in self.backtrack(path[1:j], survivors.pop()):
+                    yield label
+                path = path[j:]
+            elif len(path) > window:
+                # no convergence - commit to the best state
+                best = prevprobs.index(max(prevprobs[:len(self.states)]))
+                for label in self.backtrack(path[1:], best):
+                    yield label
+                prevprobs = [p if i == best else float('-inf')
+                             for i, p in enumerate(prevprobs)]
+                path = []
+        if path:
+            for label in self.backtrack(path[1:], self.end_step(prevprobs, t)):
+                yield label
+
+    def generate_beam(self, observations, beam=2, threshold=None,
+                      sparse=False):
+        '''
+        approximate viterbi decoder over the compiled tables: at each
+        position only the [beam] best states, and of those only the ones
+        within [threshold] (log-probability) of the best, are extended;
+        if [sparse] is True, label N-grams unseen in the transition table
+        are skipped as well, unless no state can be reached without them
+        (see beam_disagreement to measure the loss against exact decoding);
+        scores go through the best transition per last history label
+        (see compile), so a position costs [beam] terms per state
+        '''
+        observations = list(observations)
+        if self.order < 2 or not (self.compiled and self.log_transitions):
+            return self.generate(observations)
+        nstates = len(self.states)
+        beg, end = nstates, nstates + 1
+        NOPROB = float('-inf')
+        unseen = self.emission_row(len(self.observation_ids))
+        tables = sparse and self.seen_label_rows or self.label_rows
+
+        def best_score(prevprobs, alive, transitions, em_prob):
+            # best (score, last label) over the surviving last labels,
+            # ties go to the first history (as in the exact decoder)
+            [probs, hists] = transitions
+            ret = None
+            for last in alive:
+                if hists[last] < 0:
+                    continue
+                score = prevprobs[last] + probs[last] + em_prob
+                if ret is None or score > ret[0] or (
+                        score == ret[0] and hists[last] < ret[2]):
+                    ret = (score, last, hists[last])
+            return ret
+
+        # backpointers
+        path = []
+        prevprobs = self.start_probs()
+        # label ids extended at the next step
+        alive = [beg]
+        for t, observ in enumerate(self.get_observation_ids(observations)):
+            step = min(t, self.order - 1)
+            row = self.emission_row(observ)
+            currprobs = (nstates + 2) * [NOPROB]
+            pointers = nstates * [beg]
+            for tbls in (tables, self.label_rows):
+                for state in range(nstates):
+                    best = best_score(prevprobs, alive, tbls[step][state],
+                                      row[state])
+                    if best:
+                        [currprobs[state], pointers[state]] = best[:2]
+                if max(currprobs) > NOPROB:
+                    break
+            path.append(pointers)
+            prevprobs = currprobs
+            # prune states
+            ranked = sorted(range(nstates), key=lambda i: -currprobs[i])
+            alive = sorted(i for i in ranked[:beam] if threshold is None or (
+                    currprobs[i] >= currprobs[ranked[0]] - threshold))
+        if not path:
+            return []
+        # transition into the sequence end label
+        step = min(len(path), self.order - 1)
+        for tbls in (tables, self.label_rows):
+            best = best_score(prevprobs, alive, tbls[step][end], unseen[end])
+            if best:
+                break
+        return self.backtrack(path[1:], best[1])
+
+    def beam_disagreement(self, batch, beam=2, threshold=None, sparse=False):
+        '''
+        decodes a batch of observation sequences with both exact and beam
+        decoders (see generate_beam), returns the number of labels and
+        sequences compared and of those that differ, and the label
+        disagreement rate
+        '''
+        batch = [list(observations) for observations in batch]
+        ret = {'labels': 0, 'sequences': len(batch),
+               'label_errors': 0, 'sequence_errors': 0}
+        for observations, exact in zip(batch, self.generate_batch(batch)):
+            approx = self.generate_beam(observations, beam, threshold, sparse)
+            errors = sum(a != e for a, e in zip(approx, exact))
+            ret['labels'] += len(exact)
+            ret['label_errors'] += errors
+            ret['sequence_errors'] += int(errors > 0)
+        ret['rate'] = ret['labels'] and ret['label_errors'] / ret['labels']
+        return ret
+
+    def start_probs(self):
+        ''' log probabilities before the first compiled decoding step '''
+        ret = (len(self.states) + 2) * [0.0]
+        ret[len(self.states)] = math.log(1)
+        return ret
+
+    def emission_row(self, observ):
+        ''' compiled log emissions of an observation id by label id '''
+        nlabels = len(self.states) + 2
+        return memoryview(self.log_emissions)[
+                observ * nlabels:(observ + 1) * nlabels]
+
+    def transition_row(self, table, state, size):
+        '''
+        row of a label id in a compiled per-step table with rows of [size]
+        values for the model states, followed by the sequence end label
+        '''
+        row = min(state, len(self.states))
+        return memoryview(table)[row * size:(row + 1) * size]
+
+    def get_observation_ids(self, observations):
+        ''' integer ids of observations for the compiled decoder '''
+        ids = self.observation_ids
+        unseen = len(ids)
+        return [ids.get(observ, unseen) for observ in observations]
+
+    def step(self, prevprobs, observ, t):
+        '''
+        compiled decoding step [t] for an observation id given probabilities
+        at the previous step, returns probabilities and backpointers
+        '''
+        nstates = len(self.states)
+        step = min(t, self.order - 1)
+        lasts = self.history_labels[step]
+        table = self.log_transitions[step]
+        emissions = self.log_emissions
+        base = observ * (nstates + 2)
+        histprobs = [prevprobs[last] for last in lasts]
+        currprobs = (nstates + 2) * [0.0]
+        pointers = nstates * [nstates]
+        for state in range(nstates):
+            em_prob = emissions[base + state]
+            scores = [pp + tr_prob + em_prob for pp, tr_prob
+                      in zip(histprobs, table[state])]
+            maxlogprob = max(scores)
+            currprobs[state] = maxlogprob
+            pointers[state] = lasts[scores.index(maxlogprob)]
+        return currprobs, pointers
+
+    def end_step(self, prevprobs, t):
+        '''
+        compiled transition into the sequence end label after [t] steps,
+        returns the best last state id (None for empty sequences)
+        '''
+        if not t:
+            return None
+        end = len(self.states) + 1
+        step = min(t, self.order - 1)
+        lasts = self.history_labels[step]
+        em_prob = self.emission_row(len(self.observation_ids))[end]
+        scores = [prevprobs[last] + tr_prob + em_prob for last, tr_prob
+                  in zip(lasts, self.log_transitions[step][end])]
+        return lasts[scores.index(max(scores))]
+
+    def backtrack(self, path, curstate):
+        '''
+        labels of a compiled decoding path ending in state [curstate],
+        [path] holds backpointers of the positions following the first one
+        '''
+        if curstate is None:
+            return []
+        ret = [curstate]
+        for pointers in reversed(path):
+            curstate = pointers[curstate]
+            ret.append(curstate)
+        return [self.labels[i] for i in reversed(ret)]
@@ -0,0 +1,47 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import threading
+
+# loaded models: (kind, absolute path) -> (modification time, model)
+models = {}
+# guards the models dictionary (models are loaded under the lock, so that
+# concurrent requests for the same model parse it only once)
+lock = threading.Lock()
+
+
+def get_mtime(path):
+    '''
+    modification time of a model file, or the latest modification time
+    of a model directory and the files in it
+    '''
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    return max([os.path.getmtime(path)] + [
+            entry.stat().st_mtime for entry in os.scandir(path)
+            if entry.is_file()])
+
+
+def get_model(path, loader, kind=None):
+    '''
+    returns loader(path), calling the loader only on the first request
+    for the path (or once the path has been modified since); the result
+    is shared by all callers with the same [kind] (defaults to the
+    loader's name), hence must not be modified by them
+    '''
+    kind = kind or f'{loader.__module__}.{loader.__qualname__}'
+    key = (kind, os.path.abspath(path))
+    mtime = get_mtime(path)
+    with lock:
+        entry = models.get(key)
+        if entry and entry[0] == mtime:
+            return entry[1]
+        model = loader(path)
+        models[key] = (mtime, model)
+        return model
+
+
+def clear():
+    ''' forget all loaded models '''
+    with lock:
+        models.clear()
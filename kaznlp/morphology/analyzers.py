@@ -1,8 +1,12 @@
 # -*- coding: UTF-8 -*-
 
 from __future__ import division
+import collections
 import os
+import threading
 import kaznlp.morphology.utils as utils
+from kaznlp.morphology.lexicon import Lexicon
+from kaznlp.models import registry
 
 
 class AnalyzerDD():
@@ -10,10 +14,15 @@ class AnalyzerDD():
     def __init__(self, md={}, tm={}, sfx={},
                  unts=['R_X'],
                  prn_sgs=True, oov=False,
-                 sdlm=' ', mdlm='_', log=None):
+                 sdlm=' ', mdlm='_', log=None, seg_cache_size=0,
+                 cache_size=0, lexicon=None):
         self.md = md
         self.tm = tm
         self.sfx = sfx
+        # names of the dictionaries shared with other analyzers (taken
+        # from the registry, see load_model), copied before they are
+        # modified (see get_own)
+        self.shared_tables = set()
         self.unts = unts
         # self.parms = parms
         self.plm = None
@@ -22,103 +31,300 @@ class AnalyzerDD():
         self.sdlm = sdlm
         self.mdlm = mdlm
         self.log = log
+        # morphemes by left pos: [roots, reversed surface form trie],
+        # built on first use (see get_trie)
+        self.tries = {}
+        # LRU cache of partial segmentations shared across words,
+        # holding at most seg_cache_size entries (0 disables it)
+        self.seg_cache_size = seg_cache_size
+        self.seg_cache = collections.OrderedDict()
+        # LRU cache of word analyses by (word, oov, prn_sgs), holding at
+        # most cache_size entries (0 disables it), and its statistics
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # guards the caches, so that an analyzer can be shared by threads
+        self.lock = threading.Lock()
+        # precomputed analyses (see lexicon.build_lexicon), consulted
+        # before the caches and segmentation
+        self.lexicon = lexicon and Lexicon(lexicon) or None
 
-    def load_model(self, mdl_dir):
+    def load_model(self, mdl_dir, shared=True):
+        # take the dictionaries shared by all analyzers of the model
+        # (loaded at most once per process, see registry)
+        if shared:
+            [self.md, self.tm, self.sfx] = registry.get_model(
+                    mdl_dir, self.load_tables, kind='AnalyzerDD')
+            self.shared_tables = {'md', 'tm', 'sfx'}
+            self.reset_caches()
+            return
         # build morpheme and transition dictionaries
         self.getff_md(os.path.join(mdl_dir, 'md'))
         self.getff_tm(os.path.join(mdl_dir, 'tm'))
         # build suffix-paradigm mappings
         self.getff_sfx(os.path.join(mdl_dir, 'sfx'))
 
+    # open a lexicon of precomputed analyses
+    def load_lexicon(self, fn):
+        self.lexicon = Lexicon(fn)
+
+    # drop tries and cached (partial) analyses, e.g. after the
+    # dictionaries have been modified
+    def reset_caches(self):
+        with self.lock:
+            self.tries = {}
+            self.seg_cache.clear()
+            self.cache.clear()
+
+    # returns a dictionary of the analyzer (by attribute name) that can be
+    # modified: one shared with other analyzers is replaced with a copy
+    def get_own(self, name):
+        if name in self.shared_tables:
+            setattr(self, name, {k: dict(v) for k, v in getattr(
+                    self, name).items()})
+            self.shared_tables.discard(name)
+        return getattr(self, name)
+
+    # build the dictionaries of a model into new ones
+    def load_tables(self, mdl_dir):
+        lyzer = AnalyzerDD(md={}, tm={}, sfx={})
+        lyzer.load_model(mdl_dir, shared=False)
+        return [lyzer.md, lyzer.tm, lyzer.sfx]
+
     # get morpheme dictionary from file
     def getff_md(self, fn, enc='utf-8', dlm='\t', mdlm=None):
         mdlm = mdlm and mdlm or self.mdlm
+        md = self.get_own('md')
         for l in utils.get_lines(fn, enc, strip=1):
             # morpheme mapping
             [t1, t2] = l.split(dlm)
-            self.md[t2] = self.md.get(t2, {})
-            self.md[t2][t1] = 1
+            md[t2] = md.get(t2, {})
+            md[t2][t1] = 1
+        self.reset_caches()
 
     # get transition dictionary from file
     def getff_tm(self, fn, enc='utf-8', dlm='\t', mdlm=None):
         mdlm = mdlm and mdlm or self.mdlm
+        tm = self.get_own('tm')
         for l in utils.get_lines(fn, enc, strip=1):
             # morpheme mapping
             [t1, t2] = l.split(dlm)
-            self.tm[t1] = self.tm.get(t1, {})
-            self.tm[t1][t2] = 1
+            tm[t1] = tm.get(t1, {})
+            tm[t1][t2] = 1
+        self.reset_caches()
 
     # get sufix-paradigm mapping from file
     def getff_sfx(self, fn, enc='utf-8', dlm='\t', mdlm=None):
+        sfxs = self.get_own('sfx')
         for l in utils.get_lines(fn, enc, strip=1):
             [sf, sfx] = l.split(dlm)
-            self.sfx[sf] = self.sfx.get(sf, {})
-            self.sfx[sf][sfx] = 1
+            sfxs[sf] = sfxs.get(sf, {})
+            sfxs[sf][sfx] = 1
 
     # get tags for unsegmented inputs from file
     def getff_unts(self, fn, enc='utf-8'):
         self.unts = utils.get_lines(fn, enc, strip=1)
 
-    # returns segementation on shallow morphs
-    def segment(self, pfx, ret={}, cpos='*', cseq=''):
+    # returns roots and a trie of reversed surface forms of the morphemes
+    # that can precede the left pos; trie nodes are [entries, subtrie]
+    # and entries are (rank, morpheme, full morpheme as utils.Morph,
+    # surface form length), ranked in the order of the morpheme and
+    # surface form dictionaries (tries and seg_cache must be reset if md
+    # or tm are modified directly, and shared ones taken with get_own)
+    def get_trie(self, cpos):
+        if cpos in self.tries:
+            return self.tries[cpos]
+        roots = []
+        trie = {}
+        for i, m in enumerate(self.tm.get(cpos, [])):
+            if m.split(self.mdlm)[0] == 'R':
+                roots.append(((i, -1), m, None, 0))
+                continue
+            for j, msf in enumerate(self.md[m]):
+                # an empty surface form leaves no root - never matches
+                if not msf:
+                    continue
+                node = [None, trie]
+                for c in reversed(msf):
+                    node = node[1].setdefault(c, [[], {}])
+                mor = utils.Morph(msf + self.mdlm + m, self.mdlm)
+                node[0].append(((i, j), m, mor, len(msf)))
+        self.tries[cpos] = [roots, trie]
+        return self.tries[cpos]
+
+    # returns segementation on shallow morphs (analysis strings mapped
+    # to structured analyses, see utils.Analysis)
+    def segment(self, pfx, ret={}, cpos='*', cseq='', memo=None):
+        # parse sf and tag of the morph. seq (pruning depends
+        # on the seq only through them)
+        csf, ctg, cmor = None, None, ()
+        if cseq:
+            cmor = utils.parse_analysis(cseq, self.sdlm, self.mdlm)
+            csf, ctg = cmor.get_sf(), cmor.get_tg()
+        memo = {} if memo is None else memo
+        for anl in self.get_segments(pfx, cpos, csf, ctg, memo):
+            anl = utils.Analysis(anl + cmor)
+            ret.setdefault(anl.render(self.sdlm), anl)
+
+    # returns partial analyses (tuples of utils.Morph: a root and morphs
+    # up to the one preceding the morph. seq; rendered to strings only by
+    # segment) of a prefix followed by morph. seq with parse sf csf
+    # and tag ctg (None for an empty seq), in depth-first order; results
+    # are memoized per (pfx, cpos, csf, ctg, oov), or per (pfx, cpos, oov)
+    # without pruning, within a word in memo and across words in seg_cache
+    def get_segments(self, pfx, cpos, csf, ctg, memo):
+        key = self.prn_sgs and (pfx, cpos, csf, ctg, self.oov) or (
+                pfx, cpos, self.oov)
+        if key in memo:
+            return memo[key]
+        if self.seg_cache_size:
+            with self.lock:
+                if key in self.seg_cache:
+                    self.seg_cache.move_to_end(key)
+                    memo[key] = self.seg_cache[key]
+                    return memo[key]
+        anls = []
         # roots must have at least one vowel
         # (achronyms are handled by the anlysis)
-        if not (pfx and utils.get_vowels(pfx)):
-            return
-        for m in self.tm.get(cpos, []):
-            # check for root case
-            if m.split(self.mdlm)[0] == 'R':
-                # if we got a suitable root or oov roots are fine - save
-                if self.oov or pfx in self.md[m]:
-                    root = pfx + self.mdlm + m
-                    if cseq:
-                        new_anl = root + self.sdlm + cseq
-                    else:
-                        new_anl = root
-                    ret[new_anl] = 1
+        if pfx and utils.get_vowels(pfx):
+            # morphemes whose surface forms end the prefix (and roots),
+            # found by walking the trie along the reversed prefix
+            [roots, trie] = self.get_trie(cpos)
+            cands = list(roots)
+            for c in reversed(pfx):
+                node = trie.get(c)
+                if node is None:
+                    break
+                cands.extend(node[0])
+                trie = node[1]
+            cands.sort(key=lambda cand: cand[0])
+            for [rank, m, mor, n] in cands:
+                # check for root case
+                if mor is None:
+                    # if we got a suitable root or oov roots are fine - save
+                    if self.oov or pfx in self.md[m]:
+                        anls.append((utils.Morph(pfx + self.mdlm + m,
+                                                 self.mdlm), ))
+                    continue
+                # we got a suitable sf
+                new_pfx = pfx[:-1*n]
+                # no vowel in a candidate root - skip
+                if not utils.get_vowels(new_pfx):
+                    continue
+                # parse sf and tag of the updated morph. seq
+                sf = mor.sf if csf is None else mor.sf + csf
+                tg = mor.tg if ctg is None else mor.tg + '-' + ctg
+                # skip if we got unseen suffix and prune mode is on
+                if self.prn_sgs and tg not in self.sfx.get(sf, []):
+                    continue
+                # continue recursively into the depth
+                for anl in self.get_segments(new_pfx, m, sf, tg, memo):
+                    anls.append(anl + (mor, ))
+        memo[key] = anls
+        if self.seg_cache_size:
+            with self.lock:
+                self.seg_cache[key] = anls
+                if len(self.seg_cache) > self.seg_cache_size:
+                    self.seg_cache.popitem(last=False)
+        return anls
+
+    # returns analyses including all root-word possibilities
+    # (from the lexicon or the analysis cache, if enabled), as strings
+    # or as structured analyses (see utils.Analysis)
+    def analyze(self, tkn, top=0, structured=False):
+        # lexicons built with other settings are not used
+        if self.lexicon is not None and (
+                self.lexicon.oov, self.lexicon.prn_sgs) == (
+                self.oov, self.prn_sgs):
+            ret = self.lexicon.get(tkn)
+            if ret is not None:
+                return structured and self.parse_analyses(ret) or ret
+        if not self.cache_size:
+            return self.get_analyses(tkn, structured)
+        key = (tkn, self.oov, self.prn_sgs)
+        with self.lock:
+            ret = self.cache.get(key)
+            if ret is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if ret is None:
+            ret = self.get_analyses(tkn, True)
+            self.cache_analyses(key, self.render_analyses(ret))
+            return structured and ret or self.render_analyses(ret)
+        return structured and self.parse_analyses(ret) or (
+                ret[0], list(ret[1]))
+
+    # (covered, analysis strings) -> (covered, structured analyses)
+    def parse_analyses(self, anls):
+        return anls[0], [utils.parse_analysis(a, self.sdlm, self.mdlm)
+                         for a in anls[1]]
+
+    # (covered, structured analyses) -> (covered, analysis strings)
+    def render_analyses(self, anls):
+        return anls[0], [a.render(self.sdlm) for a in anls[1]]
+
+    # save analyses in the analysis cache, evicting the least recent ones
+    def cache_analyses(self, key, anls):
+        with self.lock:
+            self.cache[key] = (anls[0], tuple(anls[1]))
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    # analysis cache statistics
+    def cache_info(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self.cache),
+                    'maxsize': self.cache_size}
+
+    # seed the analysis cache from file: a word, whether it is covered
+    # (1 or 0) and its analyses per line (see save_cache); entries are
+    # keyed by the current oov and prn_sgs settings
+    def seed_cache(self, fn, enc='utf-8', dlm='\t'):
+        for l in utils.get_lines(fn, enc, strip=1):
+            ents = l.split(dlm)
+            if len(ents) < 3:
                 continue
-            # iterate through the surface forms of the morpheme
-            for msf in self.md[m]:
-                # get full morpheme - with sf; and left pos
-                mor = msf + self.mdlm + m
-                # update morph. seq
-                if cseq:
-                    new_seq = mor + self.sdlm + cseq
-                else:
-                    new_seq = mor
-                if pfx.endswith(msf):
-                    # we got a suitable sf
-                    new_pfx = pfx[:-1*len(msf)]
-                    # no vowel in a candidate root - skip
-                    if not utils.get_vowels(new_pfx):
-                        continue
-                    # skip if we got unseen suffix and prune mode is on
-                    if self.prn_sgs:
-                        sf = utils.get_parse_sf(new_seq,
-                                                self.sdlm, self.mdlm, '')
-                        tg = utils.get_parse_tg(new_seq,
-                                                self.sdlm, self.mdlm, '-')
-                        if tg not in self.sfx.get(sf, []):
-                            continue
-                    # continue recursively into the depth
-                    self.segment(new_pfx, ret, m, new_seq)
+            self.cache_analyses((ents[0], self.oov, self.prn_sgs),
+                                (ents[1] == '1', ents[2:]))
+
+    # save the analysis cache entries for the current oov and prn_sgs
+    # settings to file (see seed_cache)
+    def save_cache(self, fn, enc='utf-8', dlm='\t'):
+        with self.lock:
+            items = list(self.cache.items())
+        with open(fn, 'w', encoding=enc) as fd:
+            for [tkn, oov, prn_sgs], [cov, anls] in items:
+                if (oov, prn_sgs) == (self.oov, self.prn_sgs):
+                    fd.write(dlm.join([tkn, str(int(cov))] + list(anls)))
+                    fd.write('\n')
 
     # returns analyses including all root-word possibilities
-    def analyze(self, tkn, top=0):
+    # (bypassing the analysis cache)
+    def get_analyses(self, tkn, structured=False):
         # punctuation
         if tkn in utils.punc_tag:
-            tkn + self.mdlm + 'R_' + utils.punc_tag[tkn]
-            return False, [tkn + self.mdlm + 'R_' + utils.punc_tag[tkn]]
+            anls = [tkn + self.mdlm + 'R_' + utils.punc_tag[tkn]]
         # numerals
-        if not utils.rex_num.sub('', tkn):
-            return False, [tkn + '_R_SN']
-        # get segmentations
-        sgs = {}
-        self.segment(tkn, sgs)
-        anls = list(sgs.keys())
-        # unsegmented input tag by special tags
-        if not anls:
-            for t in self.unts:
-                anls.append(tkn + self.mdlm + t)
-
-        return bool(sgs), anls
+        elif not utils.rex_num.sub('', tkn):
+            anls = [tkn + '_R_SN']
+        else:
+            # get segmentations
+            sgs = {}
+            self.segment(tkn, sgs)
+            if sgs:
+                if structured:
+                    return True, list(sgs.values())
+                return True, list(sgs.keys())
+            # unsegmented input tag by special tags
+            anls = [tkn + self.mdlm + t for t in self.unts]
+        return structured and self.parse_analyses((False, anls)) or (
+                False, anls)
@@ -0,0 +1,166 @@
+# -*- coding: UTF-8 -*-
+
+import array
+import json
+import mmap
+import os
+import sys
+import zlib
+
+# first bytes of lexicon files
+LEXICON_MAGIC = b'KZLEXDD1'
+
+
+def build_lexicon(lyzer, words, fn):
+    '''
+    analyze a vocabulary (an iterable of words, e.g. all types of
+    a corpus) with an analyzer (AnalyzerDD) and save the analyses to
+    a lexicon file: a JSON header with the analyzer settings, followed by
+    an open addressing hash table of int64 record ids (-1 for empty
+    slots), int64 record offsets and utf-8 records of tab separated word,
+    covered flag (1 or 0) and analyses; returns the number of records
+    '''
+    records = []
+    seen = set()
+    for wrd in words:
+        if wrd in seen or '\t' in wrd or '\n' in wrd:
+            continue
+        seen.add(wrd)
+        [cov, anls] = lyzer.get_analyses(wrd)
+        records.append('\t'.join([wrd, str(int(cov))] + anls).encode('utf-8'))
+    nslots = 1
+    while nslots < 2 * len(records):
+        nslots *= 2
+    slots = array.array('q', nslots * [-1])
+    offsets = array.array('q', [0])
+    for i, rec in enumerate(records):
+        key = rec[:rec.index(b'\t')]
+        slot = zlib.crc32(key) & (nslots - 1)
+        while slots[slot] >= 0:
+            slot = (slot + 1) & (nslots - 1)
+        slots[slot] = i
+        offsets.append(offsets[-1] + len(rec))
+    header = json.dumps({
+            'byteorder': sys.byteorder,
+            'oov': lyzer.oov,
+            'prn_sgs': lyzer.prn_sgs,
+            'records': len(records),
+            'slots': nslots}).encode('utf-8')
+    header += (-len(header) % 8) * b' '
+    # write a new file and move it over the old one, which this or other
+    # processes may have open (see Lexicon)
+    tmp = f'{fn}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as fd:
+            fd.write(LEXICON_MAGIC)
+            fd.write(len(header).to_bytes(8, 'little'))
+            fd.write(header)
+            fd.write(slots.tobytes())
+            fd.write(offsets.tobytes())
+            for rec in records:
+                fd.write(rec)
+        os.replace(tmp, fn)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(records)
+
+
+class Lexicon():
+    '''
+    Read-only, memory-mapped word analysis lexicon (see build_lexicon):
+    a lookup hashes the word and compares it with the records of a few
+    hash table slots, no part of the file is loaded upfront, and
+    processes opening the same file share its pages.
+    '''
+    def __init__(self, fn):
+        with open(fn, 'rb') as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mm)
+        try:
+            if bytes(buf[:len(LEXICON_MAGIC)]) != LEXICON_MAGIC:
+                raise ValueError('Error loading lexicon.\
+                                 Not a lexicon file')
+            pos = len(LEXICON_MAGIC) + 8
+            size = int.from_bytes(buf[len(LEXICON_MAGIC):pos], 'little')
+            try:
+                header = json.loads(bytes(buf[pos:pos+size]).decode('utf-8'))
+                nrecs, nslots = header['records'], header['slots']
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('Error loading lexicon.\
+                                 Malformed lexicon header')
+            pos += size
+            end = pos + 8 * (nslots + nrecs + 1)
+            if header['byteorder'] != sys.byteorder or end > len(buf):
+                raise ValueError('Error loading lexicon.\
+                                 Lexicon file is truncated or has\
+                                 a different byte order')
+            # the last offset is the size of the records
+            size = int.from_bytes(buf[end - 8:end], sys.byteorder)
+            if end + size != len(buf):
+                raise ValueError('Error loading lexicon.\
+                                 Lexicon file is truncated')
+        except BaseException:
+            buf.release()
+            self.mm.close()
+            raise
+        self.slots = buf[pos:pos + 8 * nslots].cast('q')
+        self.offsets = buf[pos + 8 * nslots:end].cast('q')
+        self.records = buf[end:]
+        # analyzer settings the lexicon was built with
+        self.oov = header['oov']
+        self.prn_sgs = header['prn_sgs']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, wrd):
+        '''
+        returns (covered, analyses) of a word, None if it is not
+        in the lexicon
+        '''
+        key = wrd.encode('utf-8') + b'\t'
+        mask = len(self.slots) - 1
+        slot = zlib.crc32(key[:-1]) & mask
+        while True:
+            i = self.slots[slot]
+            if i < 0:
+                return None
+            start = self.offsets[i]
+            if self.records[start:start + len(key)] == key:
+                ents = bytes(self.records[start:self.offsets[i + 1]]).decode(
+                        'utf-8').split('\t')
+                return ents[1] == '1', ents[2:]
+            slot = (slot + 1) & mask
+
+
+def main(argv):
+    '''
+    builds a lexicon of all types of corpora:
+    python -m kaznlp.morphology.lexicon <model dir> <lexicon> <corpus>...
+    (corpora are tokenized and lowercased with TokenizeRex)
+    '''
+    from kaznlp.morphology.analyzers import AnalyzerDD
+    from kaznlp.tokenization.tokrex import TokenizeRex
+    if len(argv) < 4:
+        sys.stderr.write(main.__doc__)
+        return 1
+    lyzer = AnalyzerDD()
+    lyzer.load_model(argv[1])
+    tokrex = TokenizeRex()
+
+    def types():
+        for fn in argv[3:]:
+            with open(fn, 'r', encoding='utf-8') as fd:
+                for toks in tokrex.iter_tokenize(fd, lower=True):
+                    for wrd in toks:
+                        yield wrd
+
+    n = build_lexicon(lyzer, types(), argv[2])
+    sys.stderr.write(f'{n} word types saved to {argv[2]}\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -3,6 +3,7 @@
 from __future__ import division
 import kaznlp.morphology.utils as utils
 from kaznlp.morphology.analyzers import AnalyzerDD
+from kaznlp.models import registry
 
 import os
 import itertools
@@ -31,6 +32,10 @@ class TaggerHMM():
         self.lkp = lkp
         self.pc = pc
         self.own_lkp = {}
+        # names of the LMs and dictionaries shared with other taggers
+        # (taken from the registry, see load_model), copied before they
+        # are modified (see get_own)
+        self.shared_tables = set()
         # sentence dlm
         self.sen_dlm = sen_dlm
         # segementation dlm (default in parenthesis): men_R_SIM( )i_C4
@@ -54,7 +59,17 @@ class TaggerHMM():
         # set log file descriptor
         self.log = log
 
-    def load_model(self, mdl_dir):
+    def load_model(self, mdl_dir, shared=True):
+        # take the LMs and look-up dictionary shared by all taggers of
+        # the model with the same mode and parsing settings (loaded at
+        # most once per process, see registry)
+        if shared:
+            [self.transi, self.emissi, self.lkp] = registry.get_model(
+                    mdl_dir, self.load_tables, kind='TaggerHMM' + repr((
+                            self.mode, self.cw, self.gen_dlm, self.ng_dlm,
+                            self.em, self.de)))
+            self.shared_tables = {'transi', 'emissi', 'lkp'}
+            return
         # create a transition LM instance
         self.new_transi(
                 # pass transition smoothing coefficient
@@ -75,44 +90,76 @@ class TaggerHMM():
         # populate the look-up dictionary
         self.getff_lkp(os.path.join(mdl_dir, 'lkps'))
 
+    # build the LMs and look-up dictionary of a model into new ones
+    def load_tables(self, mdl_dir):
+        tagger = TaggerHMM(
+                mode=self.mode, cw=self.cw, lyzer=self.lyzer, lkp={},
+                sen_dlm=self.sen_dlm, seg_dlm=self.seg_dlm,
+                mor_dlm=self.mor_dlm, mor_jnr=self.mor_jnr,
+                gen_dlm=self.gen_dlm, ng_dlm=self.ng_dlm,
+                pc_dlm=self.pc_dlm, em=self.em, ph=self.ph, de=self.de)
+        tagger.load_model(mdl_dir, shared=False)
+        return [tagger.transi, tagger.emissi, tagger.lkp]
+
+    # returns an LM or the look-up dictionary of the tagger (by attribute
+    # name) that can be modified: one shared with other taggers is
+    # replaced with a copy
+    def get_own(self, name):
+        if name in self.shared_tables:
+            table = getattr(self, name)
+            if isinstance(table, dict):
+                table = dict(table)
+            else:
+                table = copy.copy(table)
+                table.seqs = dict(table.seqs)
+                table.voc = dict(table.voc)
+            setattr(self, name, table)
+            self.shared_tables.discard(name)
+        return getattr(self, name)
+
     # LM ROUTINES: TRANSITION
     def new_transi(self, cw=None, smth=1, log=None):
         cw = cw or self.cw
         log = log or self.log
         self.transi = utils.nglm(cw, {}, {}, smth, log)
+        self.shared_tables.discard('transi')
 
     def buildff_transi(self, fn, enc=None, dlm=None, ndlm=None, em=None):
         enc = enc or self.de
         dlm = dlm or self.gen_dlm
         ndlm = ndlm or self.ng_dlm
         em = em or self.em
-        self.transi.build_ff(fn, enc, dlm, ndlm, em)
+        self.get_own('transi').build_ff(fn, enc, dlm, ndlm, em)
 
     def set_transi(self, t):
         self.transi = t
+        self.shared_tables.discard('transi')
 
     # LM ROUTINES: EMISSION
     def new_emissi(self, smth=1, log=None):
         log = log or self.log
         self.emissi = utils.nglm(2, {}, {}, smth, log)
+        self.shared_tables.discard('emissi')
 
     def buildff_emissi(self, fn, enc=None, dlm=None, ndlm=None, em=None):
         enc = enc or self.de
         dlm = dlm or self.gen_dlm
         ndlm = ndlm or self.ng_dlm
         em = em or self.em
-        self.emissi.build_ff(fn, enc, dlm, ndlm, em)
+        self.get_own('emissi').build_ff(fn, enc, dlm, ndlm, em)
 
     def set_emissi(self, e):
         self.emissi = e
+        self.shared_tables.discard('emissi')
 
     # DICTIONARIES: LOOK-UP and PRE-COMPUTED DATA
     def getff_lkp(self, fn, enc=None, dlm=None):
         enc = enc or self.de
         dlm = dlm or self.gen_dlm
+        lkp = self.get_own('lkp')
         for l in utils.get_lines(fn, enc, strip=1):
             [sf, tg, cnt] = l.split(dlm)
-            self.lkp[sf] = self.lkp.get(sf, []) + [tg]
+            lkp[sf] = lkp.get(sf, []) + [tg]
 
     def getff_pc(self, fn, enc=None, pdlm=None, ph=None):
         enc = enc or self.de
@@ -186,19 +233,25 @@ class TaggerHMM():
             wa = self.pc.get(w, [])
             # if not in pc, check look-ups
             wa = wa and wa or self.lkp.get(w, [])
-            # if still unlucky - analyze
-            wa = wa and wa or self.lyzer.analyze(w)[-1]
-            # format for tagging and save
+            # if still unlucky - analyze (the analyzer looks the word up
+            # in its lexicon, if any, before segmenting it); analyses
+            # come structured if the analyzer uses the same delimiters
+            wa = wa and wa or self.lyzer.analyze(w, structured=(
+                    self.lyzer.sdlm, self.lyzer.mdlm) == (
+                    self.seg_dlm, self.mor_dlm))[-1]
+            # format for tagging and save (each analysis is parsed
+            # at most once, see utils.Analysis)
             tmp = []
-            for a in wa:
+            for sa in wa:
+                if isinstance(sa, str):
+                    sa = utils.parse_analysis(sa, self.seg_dlm, self.mor_dlm)
+                a = sa.render(self.seg_dlm)
                 fa = {'anl': a}
-                wrd = utils.get_parse_sf(a, self.seg_dlm, self.mor_dlm)
-                tag = utils.get_parse_tg(
-                        a, self.seg_dlm, self.mor_dlm, self.mor_jnr)
+                wrd = sa.get_sf()
+                tag = sa.get_tg(self.mor_jnr)
                 trtag = tag
                 if self.mode.count('I'):
-                    trtag = utils.get_igps(
-                            a, self.seg_dlm, self.mor_dlm, self.mor_jnr)[0][-1]
+                    trtag = sa.get_igs(self.mor_jnr)[-1]
                     if self.mode == 'I':
                         wrd = a[:a.rfind(
                                 trtag.split('-')[0])].rstrip(self.mor_dlm)
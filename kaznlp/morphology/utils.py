@@ -168,6 +168,53 @@ def get_parse_sf(p,sdlm=' ',mdlm='_',joiner=''):
     return joiner.join(sf)
 
 
+# morpheme of a structured analysis: the morpheme text (e.g. men_R_SIM),
+# its surface form, left and right parts (? if missing, as in split_morph)
+# and tag (the parts after the sf joined by mdlm, as in get_parse_tg)
+class Morph():
+    __slots__ = ('txt','sf','lp','rp','tg')
+
+    def __init__(self,txt,mdlm='_'):
+        ents = txt.split(mdlm)
+        self.txt = txt
+        self.sf = ents[0]
+        self.lp = ents[1] if len(ents)>1 else '?'
+        self.rp = ents[2] if len(ents)>2 else '?'
+        self.tg = mdlm.join(ents[1:])
+
+
+# structured analysis: a tuple of morphemes parsed once, so that the sf,
+# tag and IG-s are not re-split from the analysis string on every use;
+# render gives back the analysis string
+class Analysis(tuple):
+    __slots__ = ()
+
+    def render(self,sdlm=' '):
+        return sdlm.join([m.txt for m in self])
+
+    def get_sf(self,joiner=''):
+        return joiner.join([m.sf for m in self])
+
+    def get_tg(self,joiner='-'):
+        return joiner.join([m.tg for m in self])
+
+    # same as get_igps(...)[0]
+    def get_igs(self,ig_dlm='-'):
+        igs = [self[0].rp]
+        for m in self[1:]:
+            if not m.sf: continue
+            if m.rp=='?':
+                igs[-1] += ig_dlm + m.lp
+            else:
+                igs.append(m.rp)
+        return igs
+
+
+# parse an analysis string into a structured analysis
+def parse_analysis(p,sdlm=' ',mdlm='_'):
+    return Analysis([Morph(m,mdlm) for m in p.split(sdlm)])
+
+
 # get tag of a parse
 def get_parse_tg(p,sdlm=' ',mdlm='_',joiner='-'):
     tg = []
@@ -1,6 +1,8 @@
 # -*- coding: UTF-8 -*-
 
 from kaznlp.models.hmm import HMM_DI
+from kaznlp.models import registry
+import functools
 import re
 
 # character processing regex with replacements
@@ -18,55 +20,174 @@ CPREX = {
         }
 
 
+class CharTable(dict):
+    '''
+    Character to observation mapping. A character missing from the table
+    is mapped by the CPREX regexes (tried in their order) and stored,
+    so that each distinct character goes through the regexes only once.
+    '''
+    def __missing__(self, c):
+        ret = c
+        for rex, rep in CPREX.items():
+            if rex.match(c):
+                ret = rep
+                break
+        self[c] = ret
+        return ret
+
+
+# shared character table, pre-filled for Latin and Cyrillic blocks
+CHARS = CharTable()
+for i in range(0x500):
+    CHARS[chr(i)]
+
+
 class TokenizerHMM():
     
-    def __init__(self, implementation=HMM_DI, model=None):
-        self.hmm = implementation()
-        if model:
-            self.hmm.load_model(model)
+    def __init__(self, implementation=HMM_DI, model=None, shared=True):
+        self.implementation = implementation
+        # model file, loaded on first use of the tokenizer
+        self.model = model
+        # share the loaded model with other tokenizers (see registry)
+        self.shared = shared
+        self.loaded_hmm = None
     
-    def get_sequence(slef, txt):
-        ret = []
-        for c in txt:
-            for rex, rep in CPREX.items():
-                if rex.match(c):
-                    c = rep
-                    break
-            ret.append(c)
-        return ret
+    @property
+    def hmm(self):
+        '''
+        The HMM of the tokenizer. The model file is loaded on first access,
+        at most once per process for all shared tokenizers of the model.
+        '''
+        if self.loaded_hmm is None:
+            self.loaded_hmm = self.load_hmm()
+        return self.loaded_hmm
+    
+    @hmm.setter
+    def hmm(self, hmm):
+        self.loaded_hmm = hmm
+    
+    def load_hmm(self):
+        if not self.model:
+            return self.implementation()
+        
+        def load(model):
+            hmm = self.implementation()
+            hmm.load_model(model)
+            return hmm
+        
+        if not self.shared:
+            return load(self.model)
+        return registry.get_model(self.model, load, kind='{}.{}'.format(
+                self.implementation.__module__,
+                self.implementation.__qualname__))
+    
+    def get_sequence(self, txt):
+        return list(map(CHARS.__getitem__, txt))
     
-    def tokenize(self, txt, lower=False):        
+    def tokenize(self, txt, lower=False):
+        return self.get_sentences(
+                txt, self.hmm.generate(self.get_sequence(txt)), lower)
+
+    def tokenize_spans(self, txt, lower=False):
+        '''
+        Same as [tokenize], but each token comes as a (token, start, end)
+        tuple of the token and its offsets in [txt], so that a sentence
+        spans from the start of its first token to the end of its last one.
+        '''
+        return self.get_sentences(
+                txt, self.hmm.generate(self.get_sequence(txt)), lower, True)
+
+    def tokenize_batch(self, texts, lower=False, spans=False):
+        '''
+        Tokenizes an iterable of documents. Returns a list holding the
+        output of [tokenize] (or [tokenize_spans] if [spans] is True)
+        for each document.
+        '''
+        return [self.get_sentences(
+                txt, self.hmm.generate(self.get_sequence(txt)), lower, spans)
+                for txt in texts]
+
+    def iter_tokenize(self, stream, lower=False, spans=False, window=1000,
+                      chunk_size=65536):
+        '''
+        Tokenizes text read from a file object (in chunks of [chunk_size]
+        characters) or an iterable of strings, the whole stream being
+        a single document. Yields sentences as soon as they are final.
+        The decoder keeps at most about [window] undecided characters
+        (see HMM_DI.generate_stream), but the characters and tokens of
+        the current sentence are kept until it ends, so memory is bounded
+        by the longest sentence, not by [window]. If [spans] is True,
+        tokens come with their offsets in the stream, as in
+        [tokenize_spans].
+        '''
+        if hasattr(stream, 'read'):
+            stream = iter(functools.partial(stream.read, chunk_size), '')
+        # characters read since offset [base]
+        buff = []
+        base = 0
+
+        def observations():
+            for chunk in stream:
+                for c in chunk:
+                    buff.append(c)
+                    yield CHARS[c]
+
+        labels = self.hmm.generate_stream(observations(), window)
+        for sen in self.iter_spans(labels):
+            ret = []
+            for beg, end in sen:
+                tok = ''.join(buff[beg-base:end-base])
+                tok = tok.lower() if lower else tok
+                ret.append((tok, beg, end) if spans else tok)
+            # drop characters of the sentence (the only point where the
+            # buffer shrinks)
+            del buff[:sen[-1][-1]-base]
+            base = sen[-1][-1]
+            yield ret
+
+    def get_sentences(self, txt, labels, lower=False, spans=False):
+        '''
+        Builds sentences and tokens from the characters of [txt] and
+        their labels (see [iter_spans]), tokens are (token, start, end)
+        tuples if [spans] is True.
+        '''
         ret = []
+        for sen in self.iter_spans(labels):
+            ret.append([])
+            for beg, end in sen:
+                tok = txt[beg:end].lower() if lower else txt[beg:end]
+                ret[-1].append((tok, beg, end) if spans else tok)
+        return ret
+
+    def iter_spans(self, labels):
+        '''
+        Yields sentences as lists of (start, end) token offsets given
+        character labels: S - sentence start, T - token start,
+        I - inside a token, O - outside of tokens.
+        '''
         curr_sen = []
-        curr_tok = []
-        for i, label in enumerate(self.hmm.generate(self.get_sequence(txt))):
-            char = txt[i]
+        # start of the current token
+        curr_tok = None
+        i = 0
+        for i, label in enumerate(labels):
             if label == 'S':
-                if curr_tok:
-                    curr_tok = ''.join(curr_tok)
-                    curr_tok = curr_tok.lower() if lower else curr_tok
-                    curr_sen.append(curr_tok)
+                if curr_tok is not None:
+                    curr_sen.append((curr_tok, i))
                 if curr_sen:
-                    ret.append(curr_sen)
+                    yield curr_sen
                     curr_sen = []
-                curr_tok = [char]
+                curr_tok = i
             elif label == 'T':
-                if curr_tok:
-                    curr_tok = ''.join(curr_tok)
-                    curr_tok = curr_tok.lower() if lower else curr_tok
-                    curr_sen.append(curr_tok)
-                curr_tok = [char]
+                if curr_tok is not None:
+                    curr_sen.append((curr_tok, i))
+                curr_tok = i
             elif label == 'I':
-                curr_tok.append(char)
+                if curr_tok is None:
+                    curr_tok = i
             elif label == 'O':
-                if curr_tok:
-                    curr_tok = ''.join(curr_tok)
-                    curr_tok = curr_tok.lower() if lower else curr_tok
-                    curr_sen.append(curr_tok)
-                curr_tok = []
-        if curr_tok:
-            curr_tok = ''.join(curr_tok)
-            curr_tok = curr_tok.lower() if lower else curr_tok
-            curr_sen.append(curr_tok)
-            ret.append(curr_sen)
-        return ret
+                if curr_tok is not None:
+                    curr_sen.append((curr_tok, i))
+                curr_tok = None
+        if curr_tok is not None:
+            curr_sen.append((curr_tok, i + 1))
+            yield curr_sen
\ No newline at end of file
@@ -0,0 +1,63 @@
+# -*- coding: UTF-8 -*-
+
+import functools
+import multiprocessing
+
+# tokenizer of the current worker process
+worker_tokenizer = None
+
+
+def init_worker(tokenizer):
+    global worker_tokenizer
+    worker_tokenizer = tokenizer
+
+
+def worker_tokenize(txt, lower=False):
+    return worker_tokenizer.tokenize(txt, lower)
+
+
+class TokenizerPool():
+    '''
+    Runs a tokenizer (e.g. TokenizerHMM or TokenizeRex instance) in a pool
+    of worker processes. A tokenizer that loads its model lazily (see
+    TokenizerHMM.hmm) loads it before the workers start, and is handed
+    to each worker once, when the worker starts: with the "fork" start
+    method (default on Linux) workers share the loaded model with the
+    parent copy-on-write, otherwise each worker receives its own copy.
+    '''
+    def __init__(self, tokenizer, processes=None, chunksize=64,
+                 context=None):
+        # load the model in the parent, not once per worker
+        getattr(tokenizer, 'hmm', None)
+        # number of workers (defaults to the number of cores)
+        self.processes = processes or multiprocessing.cpu_count()
+        # number of documents sent to a worker at a time
+        self.chunksize = chunksize
+        ctx = multiprocessing.get_context(context)
+        self.pool = ctx.Pool(self.processes, initializer=init_worker,
+                             initargs=(tokenizer, ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def iter_tokenize(self, texts, lower=False, chunksize=None):
+        '''
+        Tokenizes an iterable of documents in parallel, yielding
+        the output of [tokenize] for each document in input order.
+        '''
+        return self.pool.imap(
+                functools.partial(worker_tokenize, lower=lower),
+                texts, chunksize or self.chunksize)
+
+    def tokenize(self, texts, lower=False, chunksize=None):
+        '''
+        Same as [iter_tokenize], but returns a list.
+        '''
+        return list(self.iter_tokenize(texts, lower, chunksize))
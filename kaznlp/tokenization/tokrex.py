@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 
+import functools
 import re
 
 class TokenizeRex():
@@ -7,16 +8,28 @@ class TokenizeRex():
     Regex-based tokenizer. Fast, but does not perform sentence splitting.
     '''    
     def __init__(self):
-        # regex that matches non-alphanums, non-hyphens, and non-spaces
-        self.rex_split = re.compile(
-                u'[^a-zа-яёәіңғүұқөһ\-\–\—\d\s]', re.U|re.I)
-        # regex that matches leading untokenized hyphens, e.g. "Oh [-]yes"
-        self.rex_hlead = re.compile(u'\s([\-\–\—]+)([^\s])', re.U)
-        # regex that matches trailing untokenized hyphens, e.g. "yes[-] no"
-        self.rex_htral = re.compile(u'([^\s])([\-\–\—]+)\s', re.U)
-        # regex that matches *tokenized* multiple hyphen strings,
-        # e.g. " [--] yes "
-        self.rex_hmult = re.compile(u'\s([\-\–\—]{2, })\s', re.U)
+        # alphanums, hyphens and their union (character class bodies)
+        alnum = u'a-zа-яёәіңғүұқөһ\\d'
+        hyph = u'\\-\\–\\—'
+        word = alnum + hyph
+        # single-pass token regex, alternatives are tried in order;
+        # a "chunk" below is a run of alphanums and hyphens
+        self.rex_token = re.compile(u'|'.join([
+                # hyphen at the beginning of a chunk, e.g. "Oh [-]yes"
+                u'(?<![{w}])[{h}]',
+                # alphanums with inner hyphens, e.g. "[bla-bla]"
+                u'[{a}](?:[{h}]*[{a}])*',
+                # hyphens at the end of a chunk, e.g. "yes[--] no"
+                u'(?<=[{a}])[{h}]+',
+                # rest of leading hyphens, e.g. "-[--]yes"
+                u'[{h}]+(?=[{a}])',
+                # inner and last hyphens of a hyphens-only chunk, e.g. "-[-]-"
+                u'[{h}]+(?=[{h}](?![{w}]))',
+                u'[{h}]',
+                # any other non-space character, e.g. "yes[!]"
+                u'[^{w}\\s]']).format(a=alnum, h=hyph, w=word), re.U|re.I)
+        # regex that matches a string up to its last space
+        self.rex_lspc = re.compile(u'.*\\s', re.U|re.S)
     
     def tokenize(self, txt, lower=False):
         '''
@@ -25,18 +38,49 @@ class TokenizeRex():
         always returns a single sentence, i.e. performs no sentence splitting.
         If [lower] is True the input is lowercased *after* tokenization.
         '''
-        # enclose non-alphanums, non-hyphens, and non-spaces into spaces
-        spaced = self.rex_split.sub(' \g<0> ', txt)
-        # detach hyphens
-        dehyphened = self.rex_hlead.sub(' \g<1> \g<2>', u' %s'%spaced)
-        dehyphened = self.rex_htral.sub('\g<1> \g<2> ', u'%s '%dehyphened)
-        # break multi-hyphen strings
-        while True:
-            m = self.rex_hmult.search(dehyphened)
+        toks = self.rex_token.findall(txt)
+        return [[t.lower() for t in toks] if lower else toks]
+
+    def tokenize_spans(self, txt, lower=False):
+        '''
+        Same as [tokenize], but each token comes as a (token, start, end)
+        tuple of the token and its offsets in [txt].
+        '''
+        ret = []
+        for m in self.rex_token.finditer(txt):
+            tok = m.group().lower() if lower else m.group()
+            ret.append((tok, m.start(), m.end()))
+        return [ret]
+
+    def iter_tokenize(self, stream, lower=False, spans=False,
+                      chunk_size=65536):
+        '''
+        Tokenizes text read from a file object (in chunks of [chunk_size]
+        characters) or an iterable of strings, the whole stream being
+        a single document. Text is cut after the last space of each chunk
+        (tokens never span spaces) and each piece is tokenized on its own,
+        yielding its list of tokens. Concatenated, these lists are
+        the same as the single sentence returned by [tokenize]
+        (or by [tokenize_spans] for the whole stream if [spans] is True).
+        '''
+        if hasattr(stream, 'read'):
+            stream = iter(functools.partial(stream.read, chunk_size), '')
+        rest = ''
+        # offset of [rest] in the stream
+        base = 0
+        for chunk in stream:
+            m = self.rex_lspc.match(chunk)
             if not m:
-                break
-            target = m.group(1)
-            dehyphened = dehyphened[:m.start(1)]
-            dehyphened += ' '.join(target) + dehyphened[m.end(1):]
-        dehyphened = dehyphened.lower() if lower else dehyphened
-        return [dehyphened.split()]
+                rest += chunk
+                continue
+            piece = rest + chunk[:m.end()]
+            toks = self.tokenize_spans(piece, lower)[0]
+            rest = chunk[m.end():]
+            if toks:
+                yield [(t, base + b, base + e) if spans else t
+                       for t, b, e in toks]
+            base += len(piece)
+        toks = self.tokenize_spans(rest, lower)[0]
+        if toks:
+            yield [(t, base + b, base + e) if spans else t
+                   for t, b, e in toks]
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+from kaznlp.models.hmm import BINARY_MAGIC, HMM_DI
+
+TOK_MDL = os.path.join(
+        os.path.dirname(__file__), '..', 'kaznlp', 'tokenization',
+        'tokhmm.mdl')
+
+SEQUENCES = [list('Еңбек етсең ерінбей, тояды қарның тіленбей.'),
+             list('Мен қазақ тілінде сөйлеймін. I speak English.'),
+             list('2018 ж. 12.05')]
+
+
+def corrupt_ids(fn, name):
+    ''' copy of a binary HMM_DI model file with an out of range id '''
+    with open(fn, 'rb') as fd:
+        data = bytearray(fd.read())
+    pos = len(BINARY_MAGIC) + 8
+    size = int.from_bytes(data[len(BINARY_MAGIC):pos], 'little')
+    header = json.loads(data[pos:pos+size].decode('utf-8'))
+    pos += size
+    for array_name, code, size in header['arrays']:
+        if array_name == name:
+            data[pos:pos+4] = (10 ** 6).to_bytes(4, sys.byteorder)
+            break
+        nbytes = size * {'B': 1, 'i': 4, 'd': 8}[code]
+        pos += nbytes + (-nbytes % 8)
+    fn = fn + '.' + name
+    with open(fn, 'wb') as fd:
+        fd.write(data)
+    return fn
+
+
+class BinaryModelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.model = HMM_DI(compiled=False)
+        cls.model.load_model(TOK_MDL)
+        cls.binary = os.path.join(cls.tmp.name, 'tokhmm.bin')
+        model = HMM_DI()
+        model.load_model(TOK_MDL)
+        model.save_binary(cls.binary)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def assertSameLabels(self, model):
+        for seq in SEQUENCES:
+            self.assertEqual(model.generate(seq), self.model.generate(seq))
+
+    def test_round_trip(self):
+        for compiled in [True, False]:
+            model = HMM_DI(compiled=compiled)
+            model.load_model(self.binary)
+            self.assertSameLabels(model)
+            self.assertEqual(model.transitions, self.model.transitions)
+            self.assertEqual(model.emissions, self.model.emissions)
+
+    def test_pickle(self):
+        model = HMM_DI()
+        model.load_model(self.binary)
+        self.assertSameLabels(pickle.loads(pickle.dumps(model)))
+
+    def test_save_over_mapped_file(self):
+        fn = os.path.join(self.tmp.name, 'mapped.bin')
+        shutil.copyfile(self.binary, fn)
+        model = HMM_DI()
+        model.load_model(fn)
+        model.save_binary(fn)
+        self.assertSameLabels(model)
+        other = HMM_DI()
+        other.load_model(fn)
+        self.assertSameLabels(other)
+        self.assertFalse([f for f in os.listdir(self.tmp.name)
+                          if f.endswith('.tmp')])
+
+    def test_ids_out_of_range(self):
+        for name in ['history_labels.2', 'transition_ids']:
+            model = HMM_DI()
+            with self.assertRaises(ValueError):
+                model.load_model(corrupt_ids(self.binary, name))
+                model.transitions
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+import array
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from kaznlp.lid.lidnb import BINARY_MAGIC, NB
+
+CHAR_MDL = os.path.join(
+        os.path.dirname(__file__), '..', 'kaznlp', 'lid', 'char.mdl')
+
+DOCS = [['Еңбек', 'етсең', 'ерінбей', ',', 'тояды', 'қарның', 'тіленбей'],
+        ['Мен', 'қазақ', 'тілінде', 'сөйлеймін'],
+        ['I', 'speak', 'English'],
+        ['Я', 'говорю', 'по-русски'],
+        ['2018']]
+
+
+def write_binary(fn, header, weights):
+    ''' write a binary NB model file from a header and a weights array '''
+    header = json.dumps(header).encode('utf-8')
+    header += (-len(header) % 8) * b' '
+    with open(fn, 'wb') as fd:
+        fd.write(BINARY_MAGIC)
+        fd.write(len(header).to_bytes(8, 'little'))
+        fd.write(header)
+        fd.write(weights.tobytes())
+
+
+def read_binary(fn):
+    ''' header and weights array of a binary NB model file '''
+    with open(fn, 'rb') as fd:
+        data = fd.read()
+    pos = len(BINARY_MAGIC) + 8
+    size = int.from_bytes(data[len(BINARY_MAGIC):pos], 'little')
+    header = json.loads(data[pos:pos+size].decode('utf-8'))
+    weights = array.array('d')
+    weights.frombytes(data[pos+size:])
+    return header, weights
+
+
+class BinaryModelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.model = NB(CHAR_MDL)
+        cls.binary = os.path.join(cls.tmp.name, 'char.bin')
+        cls.model.save_binary(cls.binary)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def assertSamePredictions(self, model):
+        self.assertEqual(len(model.weights), len(self.model.weights))
+        self.assertEqual(list(model.weights), list(self.model.weights))
+        for doc in DOCS:
+            self.assertEqual(model.predict_wp(doc),
+                             self.model.predict_wp(doc))
+
+    def test_round_trip(self):
+        self.assertSamePredictions(NB(self.binary))
+
+    def test_other_byte_order(self):
+        header, weights = read_binary(self.binary)
+        header['byteorder'] = {'little': 'big', 'big': 'little'}[
+                sys.byteorder]
+        weights.byteswap()
+        fn = os.path.join(self.tmp.name, 'swapped.bin')
+        write_binary(fn, header, weights)
+        self.assertSamePredictions(NB(fn))
+
+    def test_save_over_mapped_file(self):
+        fn = os.path.join(self.tmp.name, 'mapped.bin')
+        shutil.copyfile(self.binary, fn)
+        model = NB(fn)
+        model.save_binary(fn)
+        self.assertSamePredictions(model)
+        self.assertSamePredictions(NB(fn))
+        self.assertFalse([f for f in os.listdir(self.tmp.name)
+                          if f.endswith('.tmp')])
+
+    def test_unknown_byte_order(self):
+        header, weights = read_binary(self.binary)
+        header['byteorder'] = 'middle'
+        fn = os.path.join(self.tmp.name, 'unknown.bin')
+        write_binary(fn, header, weights)
+        with self.assertRaises(ValueError):
+            NB(fn)
+
+
+if __name__ == '__main__':
+    unittest.main()
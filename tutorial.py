@@ -71,9 +71,10 @@ print(f'Document "{txt_rus}" has the following language probabilities {doclan}.'
 print()
 print(f'Input document is mixed:\n"{txt_kaz} {txt_rus}".')
 print('\nPer-word language detection:')
-for i, wrd in enumerate(tokrex.tokenize(txt_kaz + txt_rus)[0]):
-    wrdlan = landetector.predict(wrd.lower())
-    print(f'{str(i+1).rjust(2)}) {wrd.ljust(15)}{wrdlan}')
+wrds = tokrex.tokenize(txt_kaz + txt_rus)[0]
+wrdlans = landetector.predict_batch([wrd.lower() for wrd in wrds])
+for i, wrd in enumerate(wrds):
+    print(f'{str(i+1).rjust(2)}) {wrd.ljust(15)}{wrdlans[i]["result"]}')
 
 
 # ============
@@ -99,6 +100,8 @@ tagger = TaggerHMM(lyzer=analyzer)
 tagger.load_model(os.path.join('kaznlp', 'morphology', 'mdl'))
 
 txt = u'Еңбек етсең ерінбей, тояды қарның тіленбей.'
+# models are loaded once per process: this tokenizer shares
+# the model of tokhmm above instead of loading it again
 tokenizer = TokenizerHMM(model=mdl)
 for sentence in tokenizer.tokenize(txt):
     print(f'input sentence:\n{sentence}\n')